@@ -0,0 +1,75 @@
+"""So sánh encode ReplacementTemplateData cho một batch 50 destination: json.dumps từng destination
+(cách cũ) với TemplateDataEncoder, có và không có orjson. Đo thời gian (timeit) và cấp phát (tracemalloc).
+
+    python Lambda/benchmarks/bench_serialization.py [--number 2000] [--body-kb 4]
+"""
+import argparse
+import json
+import timeit
+import tracemalloc
+import uuid
+
+from common import load_lambda
+
+
+def legacy_encode_batch(campaign_id, subject, message_ids, recipients, bodies):
+    return [
+        json.dumps({
+            "campaign_id": campaign_id.replace("campaign#", ""),
+            "message_id": message_id,
+            "recipient": recipient,
+            "body": body,
+            "subject": subject
+        })
+        for message_id, recipient, body in zip(message_ids, recipients, bodies)
+    ]
+
+
+def encoder_encode_batch(module, campaign_id, subject, message_ids, recipients, bodies):
+    encoder = module.TemplateDataEncoder(campaign_id, subject)
+    return [encoder.encode(message_id, recipient, body) for message_id, recipient, body in zip(message_ids, recipients, bodies)]
+
+
+def measure(name, fn, number):
+    per_batch_us = timeit.timeit(fn, number=number) / number * 1e6
+    tracemalloc.start()
+    result = fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    print(f"{name:<28}{per_batch_us:>12.1f}{peak / 1024:>14.1f}{retained / 1024:>16.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000)
+    parser.add_argument("--body-kb", type=int, default=4)
+    args = parser.parse_args()
+
+    module = load_lambda()
+    campaign_id = "campaign#abc12345"
+    subject = "Ưu đãi tháng này"
+    body = ("<p>Xin chào, nội dung chiến dịch " * (args.body_kb * 1024 // 40))[:args.body_kb * 1024] + "</p>"
+    recipients = [f"user{i}@example{i % 7}.com" for i in range(module.BATCH_SIZE)]
+    message_ids = [f"msg-{uuid.uuid4()}" for _ in recipients]
+    bodies = [body] * len(recipients)
+
+    assert [json.loads(x) for x in legacy_encode_batch(campaign_id, subject, message_ids, recipients, bodies)] == \
+        [json.loads(x) for x in encoder_encode_batch(module, campaign_id, subject, message_ids, recipients, bodies)]
+
+    print(f"{len(recipients)} destinations/batch, body {args.body_kb} KB")
+    print(f"{'variant':<28}{'us/batch':>12}{'peak KiB':>14}{'retained KiB':>16}")
+    measure("json.dumps per destination", lambda: legacy_encode_batch(campaign_id, subject, message_ids, recipients, bodies), args.number)
+
+    orjson = module.orjson
+    if orjson is not None:
+        measure("TemplateDataEncoder+orjson", lambda: encoder_encode_batch(module, campaign_id, subject, message_ids, recipients, bodies), args.number)
+    module.orjson = None
+    try:
+        measure("TemplateDataEncoder stdlib", lambda: encoder_encode_batch(module, campaign_id, subject, message_ids, recipients, bodies), args.number)
+    finally:
+        module.orjson = orjson
+
+
+if __name__ == "__main__":
+    main()
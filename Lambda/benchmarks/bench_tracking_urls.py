@@ -0,0 +1,84 @@
+"""Đo số tracking URL/giây: replace_links_with_tracking cũ (mỗi recipient làm lại từ đầu) so với
+TrackingUrlBuilder.render_batch theo batch 50 recipient.
+
+    python Lambda/benchmarks/bench_tracking_urls.py [--recipients 100000] [--links 20] [--legacy-recipients 5000]
+"""
+import argparse
+import re
+import time
+import urllib.parse
+
+from common import load_lambda
+
+
+def legacy_replace_links_with_tracking(body, campaign_id, temp_message_id, recipients):
+    # Bản cũ trước khi có TrackingUrlBuilder, bỏ logging để chỉ đo phần dựng URL
+    if not body or not isinstance(body, str):
+        return body
+
+    TRACKING_DOMAIN = "kbm7qykb6f.execute-api.us-east-1.amazonaws.com"
+    recipient = recipients[0] if recipients else ""
+
+    url_pattern = r'https?://[^\s<>"\']+|www\.[^\s<>"\']+'
+    urls = re.findall(url_pattern, body)
+
+    for url in urls:
+        if TRACKING_DOMAIN in url or '/tracking/' in url:
+            continue
+
+        img_pattern = f'<img[^>]*src=["\'][^"\']*{re.escape(url)}[^"\']*["\'][^>]*>'
+        if re.search(img_pattern, body):
+            continue
+
+        encoded_url = urllib.parse.quote(url)
+        tracking_url = (
+            f"https://{TRACKING_DOMAIN}/campaigns/"
+            f"{campaign_id.replace('campaign#', '')}/tracking/click?"
+            f"message_id={temp_message_id}&"
+            f"url={encoded_url}&"
+            f"recipient={urllib.parse.quote(recipient)}"
+        )
+        body = body.replace(url, tracking_url)
+
+    return body
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recipients", type=int, default=100000)
+    parser.add_argument("--links", type=int, default=20)
+    parser.add_argument("--legacy-recipients", type=int, default=5000)
+    args = parser.parse_args()
+
+    module = load_lambda()
+    campaign_id = "campaign#abc12345"
+    body = '<div><img src="https://cdn.example.com/logo.png"></div>' + "".join(
+        f'<p><a href="https://shop{i}.example.com/p?id={i}&ref=mail">Sản phẩm {i}</a></p>' for i in range(args.links)
+    )
+    recipients = [f"user{i}@example{i % 50}.com" for i in range(args.recipients)]
+    message_ids = [f"msg-{i:012d}" for i in range(args.recipients)]
+
+    builder = module.TrackingUrlBuilder(body, campaign_id)
+    for message_id, recipient in zip(message_ids[:20], recipients[:20]):
+        assert builder.render(message_id, recipient) == legacy_replace_links_with_tracking(body, campaign_id, message_id, [recipient])
+
+    legacy_count = min(args.legacy_recipients, args.recipients)
+    started = time.perf_counter()
+    for message_id, recipient in zip(message_ids[:legacy_count], recipients[:legacy_count]):
+        legacy_replace_links_with_tracking(body, campaign_id, message_id, [recipient])
+    legacy_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    builder = module.TrackingUrlBuilder(body, campaign_id)
+    for index in range(0, args.recipients, module.BATCH_SIZE):
+        builder.render_batch(message_ids[index:index + module.BATCH_SIZE], recipients[index:index + module.BATCH_SIZE])
+    builder_seconds = time.perf_counter() - started
+
+    print(f"{args.links} links/body, {builder.link_count} tracked")
+    print(f"legacy  : {legacy_count * builder.link_count / legacy_seconds:>12,.0f} URLs/s ({legacy_count} recipients)")
+    print(f"builder : {args.recipients * builder.link_count / builder_seconds:>12,.0f} URLs/s "
+          f"({args.recipients} recipients in {builder_seconds:.2f}s)")
+
+
+if __name__ == "__main__":
+    main()
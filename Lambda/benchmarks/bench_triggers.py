@@ -0,0 +1,81 @@
+"""Đo latency p50/p99 của lambda_handler theo từng loại trigger (SQS, scheduler, API resend, direct, sweep).
+
+    python Lambda/benchmarks/bench_triggers.py [--iterations 200] [--recipients 100] [--ses-latency-ms 0]
+"""
+import argparse
+import json
+import time
+import uuid
+
+from common import install_stubs, load_lambda, percentile
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+def seed_campaign(stubs, recipients, status="PENDING"):
+    campaign_id = f"campaign#{uuid.uuid4().hex[:8]}"
+    stubs["campaigns"].put_item(Item={
+        "campaign_id": campaign_id,
+        "email_id": "email#regular",
+        "subject": "Hello",
+        "body": "<p>Hi <a href=\"https://example.com/offer\">offer</a></p>",
+        "recipients": recipients,
+        "status": status,
+    })
+    return campaign_id
+
+
+def make_events(stubs, recipients):
+    def sqs():
+        campaign_id = seed_campaign(stubs, recipients, status="SCHEDULED")
+        body = {"campaign_id": campaign_id, "email_id": "email#regular", "recipients": recipients,
+                "subject": "Hello", "body": "<p>Hi https://example.com/offer</p>"}
+        return {"Records": [{"body": json.dumps(body), "receiptHandle": campaign_id}]}
+
+    def scheduler():
+        campaign_id = seed_campaign(stubs, recipients, status="SCHEDULED")
+        return {"messages": [{"MessageBody": json.dumps({"campaign_id": campaign_id, "email_id": "email#regular"})}]}
+
+    def api_resend():
+        campaign_id = seed_campaign(stubs, recipients, status="SENT")
+        return {"pathParameters": {"id": campaign_id.replace("campaign#", "")}}
+
+    def direct():
+        return {"to": recipients, "subject": "Hello", "body": "<p>Hi https://example.com/offer</p>"}
+
+    def sweep():
+        seed_campaign(stubs, recipients)
+        return {}
+
+    return {"sqs": sqs, "scheduler": scheduler, "api_resend": api_resend, "direct": direct, "sweep": sweep}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--recipients", type=int, default=100)
+    parser.add_argument("--ses-latency-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    module = load_lambda()
+    stubs = install_stubs(module, ses_latency=args.ses_latency_ms / 1000)
+    recipients = [f"user{i}@example{i % 10}.com" for i in range(args.recipients)]
+    context = FakeContext()
+
+    print(f"{'trigger':<12}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for trigger, make_event in make_events(stubs, recipients).items():
+        samples = []
+        for _ in range(args.iterations):
+            event = make_event()
+            assert module.classify_event(event)[0] == trigger
+            started = time.perf_counter()
+            module.lambda_handler(event, context)
+            samples.append((time.perf_counter() - started) * 1000)
+        print(f"{trigger:<12}{percentile(samples, 0.5):>10.2f}{percentile(samples, 0.99):>10.2f}{max(samples):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Nạp sendEmailLambda với stub DynamoDB/SQS/SES trong bộ nhớ để chạy benchmark cục bộ."""
+import logging
+import os
+import sys
+
+LAMBDA_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_lambda():
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+    for path in (LAMBDA_DIR, os.path.join(LAMBDA_DIR, "tests")):
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import sendEmailLambda
+    sendEmailLambda.logger.setLevel(logging.WARNING)
+    return sendEmailLambda
+
+
+def install_stubs(module, ses_latency=0.0):
+    from fakes import FakeSes, FakeSqs, InMemoryTable
+
+    conditional_error = module.dynamodb.meta.client.exceptions.ConditionalCheckFailedException
+    stubs = {
+        "campaigns": InMemoryTable(("campaign_id", "email_id"), conditional_error),
+        "ledger": InMemoryTable(("campaign_id", "batch_id"), conditional_error),
+        "tracking": InMemoryTable(("message_id",), conditional_error),
+        "sqs": FakeSqs(),
+        "ses": FakeSes(latency=ses_latency),
+    }
+    module.table = stubs["campaigns"]
+    module.ledger_table = stubs["ledger"]
+    module.dynamodb.Table = lambda name: stubs["tracking"]
+    module.sqs = stubs["sqs"]
+    module.sender_pool = module.SenderPool([
+        module.SenderEndpoint("us-east-1", module.DEFAULT_FROM_EMAIL, "cs", 1000000, client=stubs["ses"])
+    ])
+    return stubs
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
@@ -1,4 +1,5 @@
 import boto3
+import hashlib
 import json
 import logging
 import uuid
@@ -6,6 +7,13 @@ from datetime import datetime
 import re
 import urllib.parse
 import time
+import math
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -21,24 +29,328 @@ CONFIG_SET_NAME = "EmailTracking"
 MAX_RETRY_COUNT = 3
 BATCH_SIZE = 50
 
+# Lease chống gửi trùng khi SQS redeliver hoặc nhiều lần quét PENDING chạy chồng nhau
+LEDGER_TABLE_NAME = "EmailSendLedger"
+ledger_table = dynamodb.Table(LEDGER_TABLE_NAME)
+LEASE_SECONDS = 900
+# Bản ghi ledger tự xoá qua DynamoDB TTL trên thuộc tính expires_at
+LEDGER_TTL_SECONDS = 30 * 24 * 3600
+# Owner mặc định của container; lambda_handler gán owner riêng cho từng invocation để
+# invocation sau (container warm) không release được lease của invocation trước
+LEASE_OWNER = f"lease-{uuid.uuid4()}"
+invocation_state = threading.local()
+# Email đã handoff sang SQS (QUEUED): sweep bỏ qua cho tới khi lease này hết hạn
+QUEUED_LEASE_SECONDS = 300
+# Batch đang bị lease khác giữ: đẩy lại SQS sau khoảng này (tối đa của SQS DelaySeconds)
+BUSY_RETRY_DELAY_SECONDS = 900
+
+# Dự phòng thời gian để cập nhật trạng thái và handoff sang SQS trước khi Lambda timeout
+BUDGET_RESERVE_MS = 10000
+# Với timeout ngắn (mặc định của Lambda là 3s) dự phòng không vượt quá tỉ lệ này của thời gian ban đầu
+BUDGET_RESERVE_FRACTION = 0.2
+
 DEFAULT_FROM_EMAIL = "noreply@oachxalach.com"
 SUPPORT_EMAIL = "support@oachxalach.com"
+TEMPLATE_NAME = "EmailCampaignTemplate"
+TRACKING_DOMAIN = "kbm7qykb6f.execute-api.us-east-1.amazonaws.com"
+TRACKABLE_URL_PATTERN = re.compile(r'https?://[^\s<>"\']+|www\.[^\s<>"\']+')
+DEFAULT_TEMPLATE_DATA = json.dumps({"body": "Default body", "subject": "Default subject"})
+
+# Mỗi endpoint cần identity đã verify và template EmailCampaignTemplate trong region tương ứng
+SES_SENDER_ENDPOINTS = [
+    {"region": "us-east-1", "identity": DEFAULT_FROM_EMAIL, "configuration_set": CONFIG_SET_NAME, "max_send_rate": 50},
+]
+ENDPOINT_COOLDOWN_SECONDS = 30
+# Status theo từng destination cho biết endpoint bị giới hạn chứ không phải địa chỉ lỗi: gửi lại qua endpoint khác
+ENDPOINT_THROTTLE_STATUSES = {"AccountThrottled", "AccountDailyQuotaExceeded", "AccountSendingPaused", "TransientFailure"}
+
+class SenderEndpoint:
+    def __init__(self, region, identity, configuration_set, max_send_rate, weight=None, client=None):
+        self.region = region
+        self.identity = identity
+        self.configuration_set = configuration_set
+        self.max_send_rate = float(max_send_rate)
+        self.weight = float(weight or max_send_rate)
+        self.client = client or boto3.client("ses", region_name=region)
+        self.name = f"{region}/{identity}"
+        self.tokens = self.max_send_rate
+        self.last_refill = time.monotonic()
+        self.unhealthy_until = 0
+
+    def is_healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def mark_unhealthy(self, cooldown=ENDPOINT_COOLDOWN_SECONDS):
+        self.unhealthy_until = time.monotonic() + cooldown
+        logger.warning(f"SES endpoint {self.name} marked unhealthy for {cooldown}s")
+
+    def acquire(self, count):
+        # Token bucket theo max_send_rate; cho phép nợ token rồi ngủ bù
+        now = time.monotonic()
+        self.tokens = min(self.max_send_rate, self.tokens + (now - self.last_refill) * self.max_send_rate)
+        self.last_refill = now
+        self.tokens -= count
+        if self.tokens < 0:
+            wait = -self.tokens / self.max_send_rate
+            logger.info(f"Rate limiting {self.name}: sleeping {wait:.2f}s")
+            time.sleep(wait)
+
+class SenderPool:
+    def __init__(self, endpoints):
+        self.endpoints = endpoints
+        self.domain_rankings = {}
+
+    def rank(self, recipient):
+        # Weighted rendezvous hashing: cùng domain luôn ưu tiên cùng endpoint
+        domain = recipient.rsplit("@", 1)[-1].lower()
+        ranking = self.domain_rankings.get(domain)
+        if ranking is None:
+            scores = []
+            for endpoint in self.endpoints:
+                digest = hashlib.md5(f"{domain}|{endpoint.name}".encode()).digest()
+                u = (int.from_bytes(digest[:8], "big") + 1) / (2 ** 64 + 1)
+                scores.append((endpoint.weight / -math.log(u), endpoint))
+            ranking = [endpoint for _, endpoint in sorted(scores, key=lambda x: x[0], reverse=True)]
+            self.domain_rankings[domain] = ranking
+        return ranking
+
+    def route(self, recipient, excluded=()):
+        candidates = [e for e in self.rank(recipient) if e not in excluded]
+        for endpoint in candidates:
+            if endpoint.is_healthy():
+                return endpoint
+        return candidates[0] if candidates else None
+
+    def partition(self, recipients, indexes, excluded=()):
+        groups = {}
+        unroutable = []
+        for idx in indexes:
+            endpoint = self.route(recipients[idx], excluded)
+            if endpoint is None:
+                unroutable.append(idx)
+            else:
+                groups.setdefault(endpoint, []).append(idx)
+        return groups, unroutable
+
+sender_pool = SenderPool([SenderEndpoint(**config) for config in SES_SENDER_ENDPOINTS])
+
+class WorkBudget:
+    def __init__(self, context, reserve_ms=BUDGET_RESERVE_MS):
+        self.context = context
+        self.reserve_ms = min(reserve_ms, self.remaining_ms() * BUDGET_RESERVE_FRACTION)
+        self.longest_batch_ms = 0
+        self.batches_done = 0
+        self.exhausted = False
+
+    def remaining_ms(self):
+        if self.context is None or not hasattr(self.context, "get_remaining_time_in_millis"):
+            return float("inf")
+        return self.context.get_remaining_time_in_millis()
+
+    def record_batch(self, started):
+        self.longest_batch_ms = max(self.longest_batch_ms, (time.monotonic() - started) * 1000)
+        self.batches_done += 1
+
+    def can_continue(self):
+        # Luôn cho gửi ít nhất một batch để tránh vòng handoff vô hạn; sau đó chỉ bắt đầu
+        # việc mới nếu còn đủ thời gian cho batch chậm nhất cộng phần dự phòng
+        if self.batches_done == 0:
+            return True
+        if self.remaining_ms() < self.reserve_ms + self.longest_batch_ms:
+            self.exhausted = True
+            return False
+        return True
+
+def to_json(obj):
+    # orjson nếu có trong layer, không thì dùng json chuẩn
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=str).decode()
+        except TypeError:
+            pass
+    return json.dumps(obj, default=str)
+
+def encode_string(value):
+    if not isinstance(value, str):
+        return to_json(value)
+    if orjson is not None:
+        try:
+            return orjson.dumps(value).decode()
+        except TypeError:
+            # orjson từ chối surrogate đơn lẻ ("\ud800"), json chuẩn escape được
+            pass
+    return json.encoder.encode_basestring_ascii(value)
+
+class TemplateDataEncoder:
+    def __init__(self, campaign_id, subject):
+        # Phần cố định của ReplacementTemplateData chỉ encode một lần cho mỗi campaign
+        self.prefix = (
+            '{"campaign_id":' + encode_string(campaign_id.replace("campaign#", ""))
+            + ',"subject":' + encode_string(subject)
+            + ',"message_id":'
+        )
+
+    def encode(self, message_id, recipient, body):
+        return f'{self.prefix}{encode_string(message_id)},"recipient":{encode_string(recipient)},"body":{encode_string(body)}}}'
+
+def current_lease_owner():
+    return getattr(invocation_state, "lease_owner", LEASE_OWNER)
 
 def get_pending_emails():
     response = table.scan(
-        FilterExpression="#status = :status_value",
+        FilterExpression="#status = :status_value OR ((#status = :sending OR #status = :queued) AND lease_expires_at < :now)",
         ExpressionAttributeNames={"#status": "status"},
-        ExpressionAttributeValues={":status_value": "PENDING"}
+        ExpressionAttributeValues={
+            ":status_value": "PENDING",
+            ":sending": "SENDING",
+            ":queued": "QUEUED",
+            ":now": int(time.time())
+        }
     )
     return response.get("Items", [])
 
+def claim_email(campaign_id, email_id):
+    now = int(time.time())
+    try:
+        table.update_item(
+            Key={"campaign_id": campaign_id, "email_id": email_id},
+            UpdateExpression="SET #st = :sending, lease_owner = :owner, lease_expires_at = :exp",
+            # Chỉ claim email chưa gửi, đã handoff (QUEUED) hoặc lease đã hết hạn; trạng thái khác
+            # (SENT, FAILED, OPENED, CLICKED...) là đã xử lý xong, redelivery không được ghi đè
+            ConditionExpression=(
+                "attribute_exists(campaign_id) AND (#st = :pending OR #st = :scheduled OR #st = :queued"
+                " OR (#st = :sending AND lease_expires_at < :now))"
+            ),
+            ExpressionAttributeNames={"#st": "status"},
+            ExpressionAttributeValues={
+                ":sending": "SENDING",
+                ":pending": "PENDING",
+                ":scheduled": "SCHEDULED",
+                ":queued": "QUEUED",
+                ":owner": current_lease_owner(),
+                ":exp": now + LEASE_SECONDS,
+                ":now": now
+            }
+        )
+        logger.info(f"Claimed {campaign_id}/{email_id} until {now + LEASE_SECONDS}")
+        return "CLAIMED"
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        response = table.get_item(Key={"campaign_id": campaign_id, "email_id": email_id})
+        item = response.get("Item")
+        if not item:
+            return "UNTRACKED"
+        logger.info(f"Skip {campaign_id}/{email_id}: status {item.get('status')} (lease owner {item.get('lease_owner')})")
+        if item.get("status") == "SENDING":
+            return "BUSY"
+        return "DONE"
+    except Exception as e:
+        logger.error(f"Failed to claim {campaign_id}/{email_id}: {str(e)}")
+        return "UNTRACKED"
+
+def queue_email(campaign_id, email_id, lease_seconds=QUEUED_LEASE_SECONDS):
+    # Đánh dấu QUEUED trước khi handoff sang SQS để sweep sau không đẩy trùng message;
+    # invocation nhận message vẫn claim được ngay, sweep chỉ nhặt lại khi lease hết hạn
+    now = int(time.time())
+    try:
+        table.update_item(
+            Key={"campaign_id": campaign_id, "email_id": email_id},
+            UpdateExpression="SET #st = :queued, lease_owner = :owner, lease_expires_at = :exp",
+            ConditionExpression=(
+                "#st = :pending OR ((#st = :sending OR #st = :queued)"
+                " AND (lease_owner = :owner OR lease_expires_at < :now))"
+            ),
+            ExpressionAttributeNames={"#st": "status"},
+            ExpressionAttributeValues={
+                ":queued": "QUEUED",
+                ":pending": "PENDING",
+                ":sending": "SENDING",
+                ":owner": current_lease_owner(),
+                ":exp": now + lease_seconds,
+                ":now": now
+            }
+        )
+        return True
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    except Exception as e:
+        logger.error(f"Failed to queue {campaign_id}/{email_id}: {str(e)}")
+        return False
+
+def claim_batch(campaign_id, ledger_key, batch_number):
+    batch_id = f"{ledger_key}#batch#{batch_number}"
+    now = int(time.time())
+    try:
+        ledger_table.put_item(
+            Item={
+                "campaign_id": campaign_id,
+                "batch_id": batch_id,
+                "status": "SENDING",
+                "lease_owner": current_lease_owner(),
+                "lease_expires_at": now + LEASE_SECONDS,
+                "expires_at": now + LEDGER_TTL_SECONDS
+            },
+            ConditionExpression="attribute_not_exists(batch_id) OR (#st = :sending AND lease_expires_at < :now)",
+            ExpressionAttributeNames={"#st": "status"},
+            ExpressionAttributeValues={":sending": "SENDING", ":now": now}
+        )
+        return True, None
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        response = ledger_table.get_item(Key={"campaign_id": campaign_id, "batch_id": batch_id}, ConsistentRead=True)
+        return False, response.get("Item")
+    except Exception as e:
+        # Ledger lỗi thì vẫn gửi như cũ, không chặn campaign
+        logger.error(f"Failed to claim ledger batch {batch_id}: {str(e)}")
+        return True, None
+
+def complete_batch(campaign_id, ledger_key, batch_number, ses_message_ids, failed_recipients, unverified_recipients):
+    batch_id = f"{ledger_key}#batch#{batch_number}"
+    try:
+        ledger_table.put_item(Item={
+            "campaign_id": campaign_id,
+            "batch_id": batch_id,
+            "status": "SENT",
+            "lease_owner": current_lease_owner(),
+            "ses_message_ids": ses_message_ids,
+            "failed_recipients": failed_recipients,
+            "unverified_recipients": unverified_recipients,
+            "timestamp": datetime.now().isoformat(),
+            "expires_at": int(time.time()) + LEDGER_TTL_SECONDS
+        })
+    except Exception as e:
+        logger.error(f"Failed to complete ledger batch {batch_id}: {str(e)}")
+
+def release_email(campaign_id, email_id):
+    # Hết hạn lease ngay để lần xử lý tiếp theo (SQS hoặc sweep) claim lại được
+    try:
+        table.update_item(
+            Key={"campaign_id": campaign_id, "email_id": email_id},
+            UpdateExpression="SET lease_expires_at = :zero",
+            ConditionExpression="lease_owner = :owner",
+            ExpressionAttributeValues={":zero": 0, ":owner": current_lease_owner()}
+        )
+    except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as e:
+        logger.error(f"Failed to release {campaign_id}/{email_id}: {str(e)}")
+
+def release_batch(campaign_id, ledger_key, batch_number):
+    batch_id = f"{ledger_key}#batch#{batch_number}"
+    try:
+        ledger_table.delete_item(
+            Key={"campaign_id": campaign_id, "batch_id": batch_id},
+            ConditionExpression="lease_owner = :owner",
+            ExpressionAttributeValues={":owner": current_lease_owner()}
+        )
+    except Exception as e:
+        logger.error(f"Failed to release ledger batch {batch_id}: {str(e)}")
+
 def get_unopened_recipients(campaign_id):
     try:
         response = table.query(
             KeyConditionExpression="campaign_id = :cid",
             ExpressionAttributeValues={":cid": campaign_id}
         )
-        logger.info(f"DynamoDB query response in get_unopened_recipients: {json.dumps(response, default=str)}")
+        logger.info(f"DynamoDB query response in get_unopened_recipients: {to_json(response)}")
         items = response.get("Items", [])
         if not items:
             logger.error(f"Campaign not found: {campaign_id}")
@@ -90,6 +402,9 @@ def update_email_status(campaign_id, email_id, status, message_id=None, unverifi
             update_expr += ", unverified_emails = :uv"
             expr_attr_values[":uv"] = unverified_emails
 
+        if status != "SENDING":
+            update_expr += " REMOVE lease_owner, lease_expires_at"
+
         table.update_item(
             Key={"campaign_id": campaign_id, "email_id": email_id},
             UpdateExpression=update_expr,
@@ -106,7 +421,7 @@ def request_email_verification(email_address):
     try:
         response = ses.verify_email_identity(EmailAddress=email_address)
         logger.info(f"✅ Verification email sent to: {email_address}")
-        logger.info(f"SES Response: {json.dumps(response, default=str)}")
+        logger.info(f"SES Response: {to_json(response)}")
         return True
     except ses.exceptions.ClientError as e:
         error_code = e.response['Error']['Code']
@@ -116,40 +431,124 @@ def request_email_verification(email_address):
         logger.error(f"❌ Unexpected error sending verification to {email_address}: {str(e)}")
         return False
 
-def replace_links_with_tracking(body, campaign_id, temp_message_id, recipients):
-    if not body or not isinstance(body, str):
-        return body
-    
-    TRACKING_DOMAIN = "kbm7qykb6f.execute-api.us-east-1.amazonaws.com"
-    recipient = recipients[0] if recipients else ""
+class TrackingUrlBuilder:
+    def __init__(self, body, campaign_id, tracking_domain=TRACKING_DOMAIN):
+        # Body và các URL đích cố định trong cả campaign: quote một lần rồi dựng sẵn template,
+        # mỗi recipient chỉ còn điền message_id và recipient đã quote
+        self.body = body
+        self.template = None
+        self.link_count = 0
+        if not body or not isinstance(body, str):
+            return
 
-    url_pattern = r'https?://[^\s<>"\']+|www\.[^\s<>"\']+'
-    urls = re.findall(url_pattern, body)
+        prefix = f"https://{tracking_domain}/campaigns/{campaign_id.replace('campaign#', '')}/tracking/click?message_id="
+        prefix = prefix.replace("{", "{{").replace("}", "}}")
+        pieces = []
+        encoded_urls = {}
+        last_end = 0
+        skipped = 0
+        for match in TRACKABLE_URL_PATTERN.finditer(body):
+            url = match.group(0)
+            if url not in encoded_urls:
+                img_pattern = f'<img[^>]*src=["\'][^"\']*{re.escape(url)}[^"\']*["\'][^>]*>'
+                if tracking_domain in url or '/tracking/' in url or re.search(img_pattern, body):
+                    encoded_urls[url] = None
+                else:
+                    encoded_urls[url] = urllib.parse.quote(url)
+            encoded_url = encoded_urls[url]
+            if encoded_url is None:
+                skipped += 1
+                continue
+            pieces.append(body[last_end:match.start()].replace("{", "{{").replace("}", "}}"))
+            pieces.append(f"{prefix}{{0}}&url={encoded_url}&recipient={{1}}")
+            last_end = match.end()
 
-    for url in urls:
-        if TRACKING_DOMAIN in url or '/tracking/' in url:
-            logger.info(f"Skipping tracking URL: {url}")
-            continue
+        self.link_count = len(pieces) // 2
+        if self.link_count:
+            pieces.append(body[last_end:].replace("{", "{{").replace("}", "}}"))
+            self.template = "".join(pieces)
+        logger.info(f"Tracking {self.link_count} links for {campaign_id} ({skipped} skipped)")
 
-        img_pattern = f'<img[^>]*src=["\'][^"\']*{re.escape(url)}[^"\']*["\'][^>]*>'
-        if re.search(img_pattern, body):
-            logger.info(f"Skipping URL in <img> tag: {url}")
-            continue
+    def render(self, message_id, recipient):
+        if self.template is None:
+            return self.body
+        return self.template.format(message_id, urllib.parse.quote(recipient))
 
-        encoded_url = urllib.parse.quote(url)
-        tracking_url = (
-            f"https://{TRACKING_DOMAIN}/campaigns/"
-            f"{campaign_id.replace('campaign#', '')}/tracking/click?"
-            f"message_id={temp_message_id}&"
-            f"url={encoded_url}&"
-            f"recipient={urllib.parse.quote(recipient)}"
-        )
-        body = body.replace(url, tracking_url)
-        logger.info(f"Replaced: {url} → {tracking_url}")
-    
-    return body    
+    def render_batch(self, message_ids, recipients):
+        if self.template is None:
+            return [self.body] * len(recipients)
+        fill = self.template.format
+        quote = urllib.parse.quote
+        return [fill(message_id, quote(recipient)) for message_id, recipient in zip(message_ids, recipients)]
+
+def send_bulk_via_pool(recipients, destinations, from_email):
+    results = []
+    pending = list(range(len(recipients)))
+    excluded = set()
 
-def send_email(recipients, subject, body, campaign_id, from_email=None):
+    while pending:
+        groups, unroutable = sender_pool.partition(recipients, pending, excluded)
+        pending = []
+        for endpoint, indexes in groups.items():
+            endpoint.acquire(len(indexes))
+            source = from_email if from_email != DEFAULT_FROM_EMAIL else endpoint.identity
+            try:
+                logger.info(f"Sending {len(indexes)} destinations via {endpoint.name}")
+                # ✅ FIX: Đổi DefaultEmailTags thành DefaultTags
+                response = endpoint.client.send_bulk_templated_email(
+                    Source=source,
+                    Template=TEMPLATE_NAME,
+                    ConfigurationSetName=endpoint.configuration_set,
+                    ReplyToAddresses=[SUPPORT_EMAIL],
+                    DefaultTags=[  # ✅ THAY ĐỔI TỪ DefaultEmailTags
+                        {'Name': 'campaign_type', 'Value': 'marketing'},
+                    ],
+                    DefaultTemplateData=DEFAULT_TEMPLATE_DATA,
+                    Destinations=[destinations[idx] for idx in indexes]
+                )
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Batch SES response: {to_json(response)}")
+            except ses.exceptions.ClientError as e:
+                logger.error(f"SES ClientError on {endpoint.name}: {str(e.response)}")
+                endpoint.mark_unhealthy()
+                excluded.add(endpoint)
+                pending.extend(indexes)
+                continue
+            except Exception as e:
+                # Lỗi kết nối / BotoCoreError: failover như throttle, giữ kết quả của các endpoint khác
+                logger.error(f"SES error on {endpoint.name}: {str(e)}")
+                endpoint.mark_unhealthy()
+                excluded.add(endpoint)
+                pending.extend(indexes)
+                continue
+
+            statuses = response.get("BulkEmailStatuses") or response.get("Status", [])
+            logger.info(f"Batch SES response from {endpoint.name}: {len(statuses)} statuses")
+            if not statuses:
+                logger.error(f"No statuses in batch response from {endpoint.name}: {to_json(response)}")
+                endpoint.mark_unhealthy()
+                excluded.add(endpoint)
+                pending.extend(indexes)
+                continue
+            throttled = []
+            for idx, status in zip(indexes, statuses):
+                if status.get("Status") in ENDPOINT_THROTTLE_STATUSES:
+                    throttled.append(idx)
+                else:
+                    results.append((idx, status))
+            if throttled:
+                logger.warning(f"{len(throttled)} destinations throttled on {endpoint.name}, failing over")
+                endpoint.mark_unhealthy()
+                excluded.add(endpoint)
+                pending.extend(throttled)
+
+        if unroutable:
+            logger.error(f"No SES endpoint left for {len(unroutable)} destinations")
+            return results, unroutable
+
+    return results, []
+
+def send_email(recipients, subject, body, campaign_id, from_email=None, ledger_key=None, budget=None):
     if not from_email:
         from_email = DEFAULT_FROM_EMAIL
     
@@ -160,480 +559,599 @@ def send_email(recipients, subject, body, campaign_id, from_email=None):
 
     if not recipients:
         logger.error("No recipients provided")
-        return False, [], [], []
+        return False, [], [], [], False
 
     logger.info(f"Total recipients to send: {len(recipients)}")
     
     all_ses_message_ids = []
     failed_recipients = []
     unverified_recipients = []
+    # True khi còn batch chưa gửi xong (hết budget hoặc đang bị invocation khác giữ lease)
+    incomplete = False
     tracking_table = dynamodb.Table("EmailTracking")
-    template_name = "EmailCampaignTemplate"
+    template_data = TemplateDataEncoder(campaign_id, subject)
+    tracking_urls = TrackingUrlBuilder(body, campaign_id)
+    batch_started = None
     
     for batch_index in range(0, len(recipients), BATCH_SIZE):
         batch_recipients = recipients[batch_index:batch_index + BATCH_SIZE]
-        logger.info(f"Processing batch {batch_index // BATCH_SIZE + 1}: {len(batch_recipients)} recipients")
-        
-        destinations = []
-        recipient_message_ids = {}
-        
-        for recipient in batch_recipients:
-            recipient_message_id = f"msg-{uuid.uuid4()}"
-            recipient_message_ids[recipient] = recipient_message_id
-            
-            processed_body = replace_links_with_tracking(body, campaign_id, recipient_message_id, [recipient])
-            destinations.append({
-                "Destination": {"ToAddresses": [recipient]},
-                "ReplacementTemplateData": json.dumps({
-                    "campaign_id": campaign_id.replace("campaign#", ""),
-                    "message_id": recipient_message_id,
-                    "recipient": recipient,
-                    "body": processed_body,
-                    "subject": subject
-                })
-            })
+        batch_number = batch_index // BATCH_SIZE
+
+        if budget:
+            if batch_started is not None:
+                budget.record_batch(batch_started)
+                batch_started = None
+            if not budget.can_continue():
+                logger.warning(f"Time budget exhausted before batch {batch_number + 1}, stopping")
+                incomplete = True
+                break
+
+        logger.info(f"Processing batch {batch_number + 1}: {len(batch_recipients)} recipients")
+
+        if ledger_key:
+            claimed, ledger_item = claim_batch(campaign_id, ledger_key, batch_number)
+            if not claimed:
+                if ledger_item and ledger_item.get("status") == "SENT":
+                    logger.info(f"Batch {batch_number + 1} already sent, reusing ledger result")
+                    all_ses_message_ids.extend(ledger_item.get("ses_message_ids", []))
+                    failed_recipients.extend(ledger_item.get("failed_recipients", []))
+                    unverified_recipients.extend(ledger_item.get("unverified_recipients", []))
+                else:
+                    logger.info(f"Batch {batch_number + 1} is being sent by another invocation, skipping")
+                    incomplete = True
+                continue
+
+        batch_started = time.monotonic()
+        batch_ses_message_ids = []
+        batch_failed = []
+        batch_unverified = []
+        batch_completed = False
         
         try:
+            recipient_message_ids = [f"msg-{uuid.uuid4()}" for _ in batch_recipients]
+            processed_bodies = tracking_urls.render_batch(recipient_message_ids, batch_recipients)
+            destinations = [
+                {
+                    "Destination": {"ToAddresses": [recipient]},
+                    "ReplacementTemplateData": template_data.encode(recipient_message_id, recipient, processed_body)
+                }
+                for recipient, recipient_message_id, processed_body in zip(batch_recipients, recipient_message_ids, processed_bodies)
+            ]
+
             logger.info(f"Sending batch with {len(destinations)} destinations")
-            
-            # ✅ FIX: Đổi DefaultEmailTags thành DefaultTags
-            response = ses.send_bulk_templated_email(
-                Source=from_email,
-                Template=template_name,
-                ConfigurationSetName=CONFIG_SET_NAME,
-                ReplyToAddresses=[SUPPORT_EMAIL],
-                DefaultTags=[  # ✅ THAY ĐỔI TỪ DefaultEmailTags
-                    {'Name': 'campaign_type', 'Value': 'marketing'},
-                ],
-                DefaultTemplateData=json.dumps({"body": "Default body", "subject": "Default subject"}),
-                Destinations=destinations
-            )
-            logger.info(f"Batch SES response: {json.dumps(response, default=str)}")
+            results, unsent = send_bulk_via_pool(batch_recipients, destinations, from_email)
 
-            statuses = response.get("BulkEmailStatuses") or response.get("Status", [])
-            if not statuses:
-                logger.error(f"No statuses in batch response: {json.dumps(response, default=str)}")
+            if not results:
+                logger.error("No SES endpoint accepted the batch")
                 failed_recipients.extend(batch_recipients)
+                if ledger_key:
+                    release_batch(campaign_id, ledger_key, batch_number)
                 continue
-            
-            for idx, status in enumerate(statuses):
-                recipient = batch_recipients[idx]
-                recipient_message_id = recipient_message_ids[recipient]
-                
+
+            results.extend((idx, {"Status": "Failed", "Error": "All SES endpoints unavailable"}) for idx in unsent)
+            for idx, status in results:
                 if status.get("Status") == "Success":
-                    ses_message_id = status.get("MessageId")
-                    all_ses_message_ids.append(ses_message_id)
-                    
-                    tracking_table.put_item(Item={
-                        'message_id': recipient_message_id,
-                        'ses_message_id': ses_message_id,
-                        'campaign_id': campaign_id,
-                        'event_type': 'Send',
-                        'timestamp': datetime.now().isoformat(),
-                        'recipients': [recipient],
-                        'recipient_primary': recipient
-                    })
-                    logger.info(f"✓ Sent to {recipient} (RecipientMsgId: {recipient_message_id}, SESMsgId: {ses_message_id})")
+                    batch_ses_message_ids.append(status.get("MessageId"))
+                elif "not verified" in status.get("Error", "Unknown error").lower():
+                    batch_unverified.append(batch_recipients[idx])
                 else:
-                    error = status.get("Error", "Unknown error")
+                    batch_failed.append(batch_recipients[idx])
 
-                    if "not verified" in error.lower() or "email address is not verified" in error.lower():
-                        logger.warning(f"⚠️ Unverified email: {recipient}")
-                        unverified_recipients.append(recipient)
-                        verification_sent = request_email_verification(recipient)
-                        if verification_sent:
-                            logger.info(f"✅ Verification request sent to {recipient}")
+            # Ghi ledger ngay sau khi SES trả kết quả để lỗi ghi tracking không dẫn tới gửi lại
+            all_ses_message_ids.extend(batch_ses_message_ids)
+            failed_recipients.extend(batch_failed)
+            unverified_recipients.extend(batch_unverified)
+            if ledger_key:
+                complete_batch(campaign_id, ledger_key, batch_number, batch_ses_message_ids, batch_failed, batch_unverified)
+            batch_completed = True
 
-                        tracking_table.put_item(Item={
+            # Cả batch dùng chung một timestamp và ghi tracking theo lô 25 item
+            timestamp = datetime.now().isoformat()
+            with tracking_table.batch_writer() as tracking_writer:
+                for idx, status in results:
+                    recipient = batch_recipients[idx]
+                    recipient_message_id = recipient_message_ids[idx]
+                
+                    if status.get("Status") == "Success":
+                        ses_message_id = status.get("MessageId")
+                    
+                        tracking_writer.put_item(Item={
                             'message_id': recipient_message_id,
+                            'ses_message_id': ses_message_id,
                             'campaign_id': campaign_id,
-                            'event_type': 'Unverified',
-                            'timestamp': datetime.now().isoformat(),
+                            'event_type': 'Send',
+                            'timestamp': timestamp,
                             'recipients': [recipient],
-                            'recipient_primary': recipient,
-                            'error_message': error,
-                            'verification_sent': verification_sent
+                            'recipient_primary': recipient
                         })
+                        logger.info(f"✓ Sent to {recipient} (RecipientMsgId: {recipient_message_id}, SESMsgId: {ses_message_id})")
                     else:
-                        logger.error(f"✗ Failed to send to {recipient}: {error}")
-                        failed_recipients.append(recipient)
+                        error = status.get("Error", "Unknown error")
 
-                        tracking_table.put_item(Item={
-                            'message_id': recipient_message_id,
-                            'campaign_id': campaign_id,
-                            'event_type': 'Failed',
-                            'timestamp': datetime.now().isoformat(),
-                            'recipients': [recipient],
-                            'recipient_primary': recipient,
-                            'error_message': error
-                        })
-            
-            if batch_index + BATCH_SIZE < len(recipients):
-                logger.info("Sleeping 1 second between batches...")
-                time.sleep(1)
+                        if "not verified" in error.lower():
+                            logger.warning(f"⚠️ Unverified email: {recipient}")
+                            verification_sent = request_email_verification(recipient)
+                            if verification_sent:
+                                logger.info(f"✅ Verification request sent to {recipient}")
+
+                            tracking_writer.put_item(Item={
+                                'message_id': recipient_message_id,
+                                'campaign_id': campaign_id,
+                                'event_type': 'Unverified',
+                                'timestamp': timestamp,
+                                'recipients': [recipient],
+                                'recipient_primary': recipient,
+                                'error_message': error,
+                                'verification_sent': verification_sent
+                            })
+                        else:
+                            logger.error(f"✗ Failed to send to {recipient}: {error}")
+
+                            tracking_writer.put_item(Item={
+                                'message_id': recipient_message_id,
+                                'campaign_id': campaign_id,
+                                'event_type': 'Failed',
+                                'timestamp': timestamp,
+                                'recipients': [recipient],
+                                'recipient_primary': recipient,
+                                'error_message': error
+                            })
                 
-        except ses.exceptions.ClientError as e:
-            logger.error(f"SES ClientError for batch: {str(e.response)}")
-            failed_recipients.extend(batch_recipients)
-            continue
         except Exception as e:
             logger.error(f"Unexpected error sending batch: {str(e)}")
-            failed_recipients.extend(batch_recipients)
+            if not batch_completed:
+                failed_recipients.extend(batch_recipients)
+                if ledger_key:
+                    release_batch(campaign_id, ledger_key, batch_number)
             continue
+
+    if budget and batch_started is not None:
+        budget.record_batch(batch_started)
     
     success = len(all_ses_message_ids) > 0
     logger.info(f"Email sending completed: {len(all_ses_message_ids)}/{len(recipients)} successful, "
-                f"{len(failed_recipients)} failed, {len(unverified_recipients)} unverified")    
+                f"{len(failed_recipients)} failed, {len(unverified_recipients)} unverified"
+                f"{', incomplete' if incomplete else ''}")    
     
-    return success, all_ses_message_ids, failed_recipients, unverified_recipients
+    return success, all_ses_message_ids, failed_recipients, unverified_recipients, incomplete
 
-def lambda_handler(event, context):
-    logger.info("Lambda triggered: Processing emails...")
-    logger.info(f"Event received: {json.dumps(event, default=str)}")
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
+    "Access-Control-Allow-Methods": "POST,OPTIONS",
+    "Access-Control-Allow-Headers": "Authorization,Content-Type"
+}
 
-    try:
-        if "pathParameters" in event and event["pathParameters"] and "id" in event["pathParameters"]:
-            action = "resend_unopened"
-            campaign_id = event["pathParameters"]["id"]
-        elif "event" in event and isinstance(event["event"], dict):
-            action = event["event"].get("action")
-            campaign_id = event["event"].get("campaign_id")
-        else:
-            action = event.get("action")
-            campaign_id = event.get("campaign_id")
-
-        is_scheduled_event = 'time' in event.get('detail', {}) if 'detail' in event else False
-        messages = event.get("Records", [])
-        scheduler_messages = event.get("messages", None)
-
-        if messages:
-            logger.info(f"Received {len(messages)} messages from SQS")
-            for message in messages:
-                try:
-                    body_str = message["body"]
-                    logger.info(f"SQS message body: {body_str}")
-                    body = json.loads(body_str)
-                    logger.info(f"Parsed SQS message: {json.dumps(body)}")
-
-                    campaign_id = body.get("campaign_id")                               
-                    recipients = body.get("recipients", [])
-                    subject = body.get("subject", "No Subject")
-                    text_body = body.get("body", "<p>No content</p>")
-                    from_email = body.get("from_email", DEFAULT_FROM_EMAIL)
-                    email_step = body.get("email_step")
-                    email_id = body.get("email_id", "email#regular")
-
-                    if not campaign_id or not recipients:
-                        logger.error("Missing required fields")
-                        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
-                        continue
-                    
-                    if campaign_id and campaign_id.startswith("campaign#") and email_step in ["email1", "emailA", "emailB"]:
-                        try:                                       
-                            response = table.get_item(
-                                Key={"campaign_id": campaign_id, "email_id": "email#main"}
-                            )
-                            item = response.get("Item")
-                            if item and item.get("campaign_type") == "drip":
-                                config = item.get("drip_config", {})
-                                email_config = config.get(email_step)
-                                if email_config:
-                                    subject = email_config.get("subject", subject)
-                                    text_body = email_config.get("body", text_body)
-                                    logger.info(f"ĐÃ LẤY THÀNH CÔNG {email_step.upper()}: {subject}")
-                        except Exception as e:
-                            logger.error(f"Lỗi khi lấy drip_config: {str(e)}")
-                    
-                    success, ses_message_ids, failed_recipients, unverified_recipients = send_email(
-                        recipients, subject, text_body, campaign_id, from_email
-                    )
+def api_response(status_code, message):
+    return {"statusCode": status_code, "headers": CORS_HEADERS, "body": json.dumps({"message": message})}
 
-                    if success:
-                        if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
-                            update_email_status(campaign_id, email_id, "SENT")
-                            logger.info(f"EMAIL GỬI THÀNH CÔNG: {campaign_id} - {email_step or 'regular'}")
-                        else:
-                            if len(unverified_recipients) > 0:
-                                update_email_status(
-                                    campaign_id, email_id, "PENDING_VERIFICATION",
-                                    unverified_emails=unverified_recipients
-                                )
-                                logger.warning(f"⚠️ PENDING VERIFICATION: {len(unverified_recipients)} emails cần xác thực")
-                            else:
-                                update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
-                                logger.warning(f"Partial success: {len(failed_recipients)} failed out of {len(recipients)}")
-                        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
-                    else:
-                        if len(unverified_recipients) > 0:
-                            update_email_status(
-                                campaign_id, email_id, "PENDING_VERIFICATION",
-                                unverified_emails=unverified_recipients
-                            )
-                            logger.warning(f"⚠️ Campaign {campaign_id} chờ xác thực email")
-                        else:
-                            update_email_status(campaign_id, email_id, "FAILED")
-                            logger.error(f"GỬI EMAIL THẤT BẠI: {campaign_id}")
-                        sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
-                        
-                except Exception as e:
-                    logger.error(f"Error processing SQS message: {str(e)}")
-                    sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
-                    continue
-                    
-        elif scheduler_messages:
-            logger.info(f"Received {len(scheduler_messages)} messages from EventBridge Scheduler")
-            for msg in scheduler_messages:
-                try:
-                    message_body_str = msg.get("MessageBody", "{}")
-                    body = json.loads(message_body_str)
-                    logger.info(f"Parsed scheduler message: {json.dumps(body)}")
-                    
-                    campaign_id = body.get("campaign_id")
-                    email_id = body.get("email_id", "email#regular")
-                    from_email = body.get("from_email", DEFAULT_FROM_EMAIL)
+def classify_event(event):
+    if "Records" in event and event["Records"]:
+        return "sqs", event["Records"]
+    if event.get("messages"):
+        return "scheduler", event["messages"]
 
-                    if not campaign_id:
-                        logger.error("Missing campaign_id in scheduler message")
-                        continue
+    if "pathParameters" in event and event["pathParameters"] and "id" in event["pathParameters"]:
+        return "api_resend", event["pathParameters"]["id"]
+    if "event" in event and isinstance(event["event"], dict):
+        action = event["event"].get("action")
+        campaign_id = event["event"].get("campaign_id")
+    else:
+        action = event.get("action")
+        campaign_id = event.get("campaign_id")
+    if action == "resend_unopened":
+        return "api_resend", campaign_id
 
-                    response = table.get_item(Key={"campaign_id": campaign_id, "email_id": email_id})
-                    item = response.get("Item")
-                    if not item:
-                        logger.error(f"No item found for campaign_id={campaign_id}, email_id={email_id}")
-                        continue
+    is_scheduled_event = 'time' in event.get('detail', {}) if 'detail' in event else False
+    if is_scheduled_event or ('to' in event and 'subject' in event and 'body' in event):
+        return "direct", event
 
-                    recipients = item.get("recipients", [])
-                    if isinstance(recipients, str):
-                        recipients = [recipients]
-                    subject = item.get("subject", "No Subject")
-                    text_body = item.get("body", "<p>No content</p>")
+    return "sweep", None
 
-                    if not recipients:
-                        logger.warning(f"No recipients for {campaign_id}")
-                        continue
+def hand_off(message_body, delay_seconds=0):
+    if not isinstance(message_body, str):
+        message_body = to_json(message_body)
+    sqs.send_message(QueueUrl=SQS_QUEUE_URL, MessageBody=message_body, DelaySeconds=delay_seconds)
+    logger.info(f"Handed off to SQS: {message_body[:200]}")
 
-                    logger.info(f"Sending scheduled email for {campaign_id} to {len(recipients)} recipients")
-                    
-                    success, ses_message_ids, failed_recipients, unverified_recipients = send_email(
-                        recipients, subject, text_body, campaign_id, from_email
+def hand_off_incomplete(campaign_id, email_id, message_body, budget):
+    # Chưa gửi xong thì không ghi trạng thái cuối, ledger sẽ bỏ qua các batch đã gửi.
+    # Hết thời gian: nhả lease để message đẩy lại xử lý ngay. Batch đang bận: giữ QUEUED tới
+    # lúc message trễ tới nơi để sweep không nhặt lại và đẩy thêm message mỗi lần chạy
+    if budget.exhausted:
+        release_email(campaign_id, email_id)
+        hand_off(message_body)
+    else:
+        queue_email(campaign_id, email_id, BUSY_RETRY_DELAY_SECONDS)
+        hand_off(message_body, BUSY_RETRY_DELAY_SECONDS)
+
+def handle_sqs(messages, budget):
+    logger.info(f"Received {len(messages)} messages from SQS")
+    for position, message in enumerate(messages):
+        if not budget.can_continue():
+            logger.warning(f"Time budget exhausted, handing off {len(messages) - position} SQS messages")
+            for remaining in messages[position:]:
+                hand_off(remaining["body"])
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=remaining["receiptHandle"])
+            break
+
+        try:
+            body_str = message["body"]
+            logger.info(f"SQS message body: {body_str}")
+            body = json.loads(body_str)
+            logger.info(f"Parsed SQS message: {to_json(body)}")
+
+            campaign_id = body.get("campaign_id")                               
+            recipients = body.get("recipients", [])
+            subject = body.get("subject", "No Subject")
+            text_body = body.get("body", "<p>No content</p>")
+            from_email = body.get("from_email", DEFAULT_FROM_EMAIL)
+            email_step = body.get("email_step")
+            email_id = body.get("email_id", "email#regular")
+
+            if campaign_id and not recipients and "email_id" in body:
+                # Message được handoff từ scheduler có thể chỉ chứa khóa của campaign
+                item = table.get_item(Key={"campaign_id": campaign_id, "email_id": email_id}).get("Item") or {}
+                recipients = item.get("recipients", [])
+                if isinstance(recipients, str):
+                    recipients = [recipients]
+                subject = item.get("subject", subject)
+                text_body = item.get("body", text_body)
+
+            if not campaign_id or not recipients:
+                logger.error("Missing required fields")
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+                continue
+            
+            if campaign_id and campaign_id.startswith("campaign#") and email_step in ["email1", "emailA", "emailB"]:
+                try:                                       
+                    response = table.get_item(
+                        Key={"campaign_id": campaign_id, "email_id": "email#main"}
                     )
-                    
-                    if success:
-                        if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
-                            update_email_status(campaign_id, email_id, "SENT")
-                        elif len(unverified_recipients) > 0:
-                            update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                        else:
-                            update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
+                    item = response.get("Item")
+                    if item and item.get("campaign_type") == "drip":
+                        config = item.get("drip_config", {})
+                        email_config = config.get(email_step)
+                        if email_config:
+                            subject = email_config.get("subject", subject)
+                            text_body = email_config.get("body", text_body)
+                            logger.info(f"ĐÃ LẤY THÀNH CÔNG {email_step.upper()}: {subject}")
+                except Exception as e:
+                    logger.error(f"Lỗi khi lấy drip_config: {str(e)}")
+
+            if claim_email(campaign_id, email_id) in ("BUSY", "DONE"):
+                logger.info(f"Duplicate delivery for {campaign_id}/{email_id}, skipping")
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+                continue
+
+            ledger_key = f"{email_id}#{email_step}" if email_step else email_id
+            success, ses_message_ids, failed_recipients, unverified_recipients, incomplete = send_email(
+                recipients, subject, text_body, campaign_id, from_email, ledger_key=ledger_key, budget=budget
+            )
+
+            if incomplete:
+                hand_off_incomplete(campaign_id, email_id, body_str, budget)
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+                continue
+
+            if success:
+                if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
+                    update_email_status(campaign_id, email_id, "SENT")
+                    logger.info(f"EMAIL GỬI THÀNH CÔNG: {campaign_id} - {email_step or 'regular'}")
+                else:
+                    if len(unverified_recipients) > 0:
+                        update_email_status(
+                            campaign_id, email_id, "PENDING_VERIFICATION",
+                            unverified_emails=unverified_recipients
+                        )
+                        logger.warning(f"⚠️ PENDING VERIFICATION: {len(unverified_recipients)} emails cần xác thực")
                     else:
-                        if len(unverified_recipients) > 0:
-                            update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                        else:
-                            update_email_status(campaign_id, email_id, "FAILED")
+                        update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
+                        logger.warning(f"Partial success: {len(failed_recipients)} failed out of {len(recipients)}")
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+            else:
+                if len(unverified_recipients) > 0:
+                    update_email_status(
+                        campaign_id, email_id, "PENDING_VERIFICATION",
+                        unverified_emails=unverified_recipients
+                    )
+                    logger.warning(f"⚠️ Campaign {campaign_id} chờ xác thực email")
+                else:
+                    update_email_status(campaign_id, email_id, "FAILED")
+                    logger.error(f"GỬI EMAIL THẤT BẠI: {campaign_id}")
+                sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+                
+        except Exception as e:
+            logger.error(f"Error processing SQS message: {str(e)}")
+            sqs.delete_message(QueueUrl=SQS_QUEUE_URL, ReceiptHandle=message["receiptHandle"])
+            continue
 
-                except Exception as e:
-                    logger.error(f"Error processing scheduler message: {str(e)}")
-                    continue
+    return {"statusCode": 200, "body": "Emails processed successfully"}
+
+def handle_scheduler(scheduler_messages, budget):
+    logger.info(f"Received {len(scheduler_messages)} messages from EventBridge Scheduler")
+    for position, msg in enumerate(scheduler_messages):
+        if not budget.can_continue():
+            logger.warning(f"Time budget exhausted, handing off {len(scheduler_messages) - position} scheduler messages")
+            for remaining in scheduler_messages[position:]:
+                hand_off(remaining.get("MessageBody", "{}"))
+            break
+
+        try:
+            message_body_str = msg.get("MessageBody", "{}")
+            body = json.loads(message_body_str)
+            logger.info(f"Parsed scheduler message: {to_json(body)}")
+            
+            campaign_id = body.get("campaign_id")
+            email_id = body.get("email_id", "email#regular")
+            from_email = body.get("from_email", DEFAULT_FROM_EMAIL)
 
-        elif action == "resend_unopened":
             if not campaign_id:
-                logger.error("Missing campaign_id for resend_unopened")
-                return {
-                    "statusCode": 400,
-                    "headers": {
-                        "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
-                        "Access-Control-Allow-Methods": "POST,OPTIONS",
-                        "Access-Control-Allow-Headers": "Authorization,Content-Type"
-                    }, 
-                    "body": json.dumps({"message": "Missing campaign_id"})
-                }
+                logger.error("Missing campaign_id in scheduler message")
+                continue
 
-            campaign_id = campaign_id if campaign_id.startswith("campaign#") else f"campaign#{campaign_id}"
-            logger.info(f"Normalized campaign_id for resend: {campaign_id}")
-
-            response = table.query(KeyConditionExpression="campaign_id = :cid", ExpressionAttributeValues={":cid": campaign_id})
-            logger.info(f"DynamoDB query response: {json.dumps(response, default=str)}")
-            items = response.get("Items", [])
-            if not items:
-                logger.error(f"Campaign not found: {campaign_id}")
-                return {
-                    "statusCode": 404,
-                    "headers": {
-                        "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
-                        "Access-Control-Allow-Methods": "POST,OPTIONS",
-                        "Access-Control-Allow-Headers": "Authorization,Content-Type"
-                    },
-                    "body": json.dumps({"message": "Campaign not found"})
-                }
+            response = table.get_item(Key={"campaign_id": campaign_id, "email_id": email_id})
+            item = response.get("Item")
+            if not item:
+                logger.error(f"No item found for campaign_id={campaign_id}, email_id={email_id}")
+                continue
 
-            campaign = items[0]
-            logger.info(f"Found campaign: {json.dumps(campaign, default=str)}")
+            recipients = item.get("recipients", [])
+            if isinstance(recipients, str):
+                recipients = [recipients]
+            subject = item.get("subject", "No Subject")
+            text_body = item.get("body", "<p>No content</p>")
+
+            if not recipients:
+                logger.warning(f"No recipients for {campaign_id}")
+                continue
+
+            if claim_email(campaign_id, email_id) in ("BUSY", "DONE"):
+                continue
+
+            logger.info(f"Sending scheduled email for {campaign_id} to {len(recipients)} recipients")
             
-            unopened_recipients = get_unopened_recipients(campaign_id)
-            if not unopened_recipients:
-                logger.info(f"No unopened recipients found for campaign: {campaign_id}")
-                return {
-                    "statusCode": 200,
-                    "headers": {
-                        "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
-                        "Access-Control-Allow-Methods": "POST,OPTIONS",
-                        "Access-Control-Allow-Headers": "Authorization,Content-Type"
-                    },
-                    "body": json.dumps({"message": "No unopened recipients found"})
-                }
+            success, ses_message_ids, failed_recipients, unverified_recipients, incomplete = send_email(
+                recipients, subject, text_body, campaign_id, from_email, ledger_key=email_id, budget=budget
+            )
 
-            new_campaign_id = f"campaign#{str(uuid.uuid4())[:8]}"
-            new_email_id = f"email#{str(uuid.uuid4())[:8]}"
-            subject = campaign.get("subject", "")
-            text_body = campaign.get("body", "")
-            from_email = DEFAULT_FROM_EMAIL
+            if incomplete:
+                hand_off_incomplete(campaign_id, email_id, {"campaign_id": campaign_id, "email_id": email_id, "from_email": from_email}, budget)
+                continue
+            
+            if success:
+                if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
+                    update_email_status(campaign_id, email_id, "SENT")
+                elif len(unverified_recipients) > 0:
+                    update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
+                else:
+                    update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
+            else:
+                if len(unverified_recipients) > 0:
+                    update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
+                else:
+                    update_email_status(campaign_id, email_id, "FAILED")
 
-            campaign_record = {
-                "campaign_id": new_campaign_id,
-                "email_id": new_email_id,
-                "subject": subject,
-                "body": text_body,
-                "recipients": unopened_recipients,
-                "status": "PENDING",
-                "timestamp": datetime.now().isoformat(),
-                "original_campaign_id": campaign_id
-            }
-            table.put_item(Item=campaign_record)
-            logger.info(f"Created resend campaign: {new_campaign_id}")
-
-            sqs.send_message(QueueUrl=SQS_QUEUE_URL, MessageBody=json.dumps({
-                "campaign_id": new_campaign_id, 
-                "email_id": new_email_id, 
-                "from_email": from_email,
-                "recipients": unopened_recipients,
+        except Exception as e:
+            logger.error(f"Error processing scheduler message: {str(e)}")
+            continue
+
+    return {"statusCode": 200, "body": "Emails processed successfully"}
+
+def handle_api_resend(campaign_id, budget):
+    if not campaign_id:
+        logger.error("Missing campaign_id for resend_unopened")
+        return api_response(400, "Missing campaign_id")
+
+    campaign_id = campaign_id if campaign_id.startswith("campaign#") else f"campaign#{campaign_id}"
+    logger.info(f"Normalized campaign_id for resend: {campaign_id}")
+
+    response = table.query(KeyConditionExpression="campaign_id = :cid", ExpressionAttributeValues={":cid": campaign_id})
+    logger.info(f"DynamoDB query response: {to_json(response)}")
+    items = response.get("Items", [])
+    if not items:
+        logger.error(f"Campaign not found: {campaign_id}")
+        return api_response(404, "Campaign not found")
+
+    campaign = items[0]
+    logger.info(f"Found campaign: {to_json(campaign)}")
+    
+    unopened_recipients = get_unopened_recipients(campaign_id)
+    if not unopened_recipients:
+        logger.info(f"No unopened recipients found for campaign: {campaign_id}")
+        return api_response(200, "No unopened recipients found")
+
+    new_campaign_id = f"campaign#{str(uuid.uuid4())[:8]}"
+    new_email_id = f"email#{str(uuid.uuid4())[:8]}"
+    subject = campaign.get("subject", "")
+    text_body = campaign.get("body", "")
+    from_email = DEFAULT_FROM_EMAIL
+
+    campaign_record = {
+        "campaign_id": new_campaign_id,
+        "email_id": new_email_id,
+        "subject": subject,
+        "body": text_body,
+        "recipients": unopened_recipients,
+        "status": "PENDING",
+        "timestamp": datetime.now().isoformat(),
+        "original_campaign_id": campaign_id
+    }
+    table.put_item(Item=campaign_record)
+    logger.info(f"Created resend campaign: {new_campaign_id}")
+
+    hand_off({
+        "campaign_id": new_campaign_id, 
+        "email_id": new_email_id, 
+        "from_email": from_email,
+        "recipients": unopened_recipients,
+        "subject": subject,
+        "body": text_body
+    })
+    return api_response(200, f"Resend campaign created: {new_campaign_id}")
+
+def handle_direct(event, budget):
+    logger.info("Processing direct event from EventBridge or test invocation")
+    if 'detail' in event and isinstance(event['detail'], dict):
+        detail = event['detail']
+        recipients = detail.get("to", [])
+        subject = detail.get("subject", "")
+        text_body = detail.get("body", "")
+    else:
+        recipients = event.get("to", [])
+        subject = event.get("subject", "")
+        text_body = event.get("body", "")
+
+    if isinstance(recipients, str):
+        recipients = [recipients]
+
+    campaign_id = f"campaign#{str(uuid.uuid4())[:8]}"
+    email_id = f"email#{str(uuid.uuid4())[:8]}"
+
+    logger.info(f"Creating campaign: {campaign_id}, email: {email_id} for recipients: {recipients}")
+
+    try:
+        temp_message_id = f"msg-{uuid.uuid4()}"
+        campaign_record = {
+            "campaign_id": campaign_id,
+            "email_id": email_id,
+            "subject": subject,
+            "body": text_body,
+            "recipients": recipients,
+            "status": "SENDING",
+            "lease_owner": current_lease_owner(),
+            "lease_expires_at": int(time.time()) + LEASE_SECONDS,
+            "timestamp": datetime.now().isoformat(),
+            "message_id": temp_message_id
+        }
+
+        logger.info(f"Saving campaign record to DynamoDB: {to_json(campaign_record)}")
+        table.put_item(Item=campaign_record)
+        logger.info(f"Campaign {campaign_id} created successfully in DynamoDB")
+
+        success, ses_message_ids, failed_recipients, unverified_recipients, incomplete = send_email(
+            recipients, subject, text_body, campaign_id, DEFAULT_FROM_EMAIL, ledger_key=email_id, budget=budget
+        )
+
+        if incomplete:
+            hand_off_incomplete(campaign_id, email_id, {
+                "campaign_id": campaign_id,
+                "email_id": email_id,
+                "from_email": DEFAULT_FROM_EMAIL,
+                "recipients": recipients,
                 "subject": subject,
                 "body": text_body
-            }))
-            return {
-                "statusCode": 200,
-                "headers": {
-                    "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
-                    "Access-Control-Allow-Methods": "POST,OPTIONS",
-                    "Access-Control-Allow-Headers": "Authorization,Content-Type"
-                }, 
-                "body": json.dumps({"message": f"Resend campaign created: {new_campaign_id}"})
-            }
-
-        elif is_scheduled_event or ('to' in event and 'subject' in event and 'body' in event):
-            logger.info("Processing direct event from EventBridge or test invocation")
-            if 'detail' in event and isinstance(event['detail'], dict):
-                detail = event['detail']
-                recipients = detail.get("to", [])
-                subject = detail.get("subject", "")
-                text_body = detail.get("body", "")
+            }, budget)
+        elif success:
+            if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
+                for ses_message_id in ses_message_ids:
+                    update_email_status(campaign_id, email_id, "SENT", message_id=ses_message_id)
+                logger.info(f"Email status updated to SENT")
+            elif len(unverified_recipients) > 0:
+                update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
+            else:
+                update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
+                logger.warning(f"Partial send: {len(failed_recipients)} failed")
+        else:
+            if len(unverified_recipients) > 0:
+                update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
             else:
-                recipients = event.get("to", [])
-                subject = event.get("subject", "")
-                text_body = event.get("body", "")
+                update_email_status(campaign_id, email_id, "FAILED")
+                logger.error(f"Failed to send email")
 
+    except Exception as e:
+        logger.error(f"Failed to process direct event: {str(e)}")
+
+    return {"statusCode": 200, "body": "Emails processed successfully"}
+
+def handle_sweep(payload, budget):
+    logger.info("Fetching pending emails from DynamoDB")
+    pending_emails = get_pending_emails()
+    logger.info(f"Found {len(pending_emails)} pending emails in DynamoDB")
+
+    for email in pending_emails:
+        try:
+            if email.get("campaign_type") == "drip":
+                logger.info(f"Skip drip campaign: {email.get('campaign_id')}")
+                continue
+            
+            campaign_id = email.get("campaign_id")
+            email_id = email.get("email_id")
+            subject = email.get("subject", "No Subject (old campaign)")
+            body = email.get("body", "<p>No content (old campaign)</p>")
+            recipients = email.get("recipients", [])
             if isinstance(recipients, str):
                 recipients = [recipients]
+            if not recipients:
+                logger.warning(f"Skip pending email {email_id}: no recipients")
+                continue
 
-            campaign_id = f"campaign#{str(uuid.uuid4())[:8]}"
-            email_id = f"email#{str(uuid.uuid4())[:8]}"
-
-            logger.info(f"Creating campaign: {campaign_id}, email: {email_id} for recipients: {recipients}")
+            handoff_body = {
+                "campaign_id": campaign_id,
+                "email_id": email_id,
+                "from_email": DEFAULT_FROM_EMAIL,
+                "recipients": recipients,
+                "subject": subject,
+                "body": body
+            }
+            if not budget.can_continue():
+                # Invocation xử lý message sẽ tự claim; email đã bị sweep khác đẩy đi thì bỏ qua
+                if queue_email(campaign_id, email_id):
+                    hand_off(handoff_body)
+                continue
 
-            try:
-                temp_message_id = f"msg-{uuid.uuid4()}"
-                campaign_record = {
-                    "campaign_id": campaign_id,
-                    "email_id": email_id,
-                    "subject": subject,
-                    "body": text_body,
-                    "recipients": recipients,
-                    "status": "PENDING",
-                    "timestamp": datetime.now().isoformat(),
-                    "message_id": temp_message_id
-                }
+            if claim_email(campaign_id, email_id) != "CLAIMED":
+                continue
 
-                logger.info(f"Saving campaign record to DynamoDB: {json.dumps(campaign_record)}")
-                table.put_item(Item=campaign_record)
-                logger.info(f"Campaign {campaign_id} created successfully in DynamoDB")
+            logger.info(f"Processing old pending email {email_id} to {recipients}")
+            
+            success, _, failed_recipients, unverified_recipients, incomplete = send_email(
+                recipients, subject, body, campaign_id, DEFAULT_FROM_EMAIL, ledger_key=email_id, budget=budget
+            )
 
-                success, ses_message_ids, failed_recipients, unverified_recipients = send_email(
-                    recipients, subject, text_body, campaign_id, DEFAULT_FROM_EMAIL
-                )
-                
-                if success:
-                    if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
-                        for ses_message_id in ses_message_ids:
-                            update_email_status(campaign_id, email_id, "SENT", message_id=ses_message_id)
-                        logger.info(f"Email status updated to SENT")
-                    elif len(unverified_recipients) > 0:
-                        update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                    else:
-                        update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
-                        logger.warning(f"Partial send: {len(failed_recipients)} failed")
+            if incomplete:
+                hand_off_incomplete(campaign_id, email_id, handoff_body, budget)
+                continue
+            
+            if success:
+                if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
+                    update_email_status(campaign_id, email_id, "SENT")
+                elif len(unverified_recipients) > 0:
+                    update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
                 else:
-                    if len(unverified_recipients) > 0:
-                        update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                    else:
-                        update_email_status(campaign_id, email_id, "FAILED")
-                        logger.error(f"Failed to send email")
+                    update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
+            else:
+                if len(unverified_recipients) > 0:
+                    update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
+                else:
+                    update_email_status(campaign_id, email_id, "FAILED")
+        except Exception as e:
+            logger.error(f"Error processing pending email {email.get('campaign_id', 'unknown')}: {str(e)}")
+            continue
 
-            except Exception as e:
-                logger.error(f"Failed to process direct event: {str(e)}")
-
-        logger.info("Fetching pending emails from DynamoDB")
-        pending_emails = get_pending_emails()
-        logger.info(f"Found {len(pending_emails)} pending emails in DynamoDB")
-
-        if pending_emails:
-            for email in pending_emails:
-                try:
-                    if email.get("campaign_type") == "drip":
-                        logger.info(f"Skip drip campaign: {email.get('campaign_id')}")
-                        continue
-                    
-                    campaign_id = email.get("campaign_id")
-                    email_id = email.get("email_id")
-                    subject = email.get("subject", "No Subject (old campaign)")
-                    body = email.get("body", "<p>No content (old campaign)</p>")
-                    recipients = email.get("recipients", [])
-                    if isinstance(recipients, str):
-                        recipients = [recipients]
-                    if not recipients:
-                        logger.warning(f"Skip pending email {email_id}: no recipients")
-                        continue
-                    
-                    logger.info(f"Processing old pending email {email_id} to {recipients}")
-                    
-                    success, _, failed_recipients, unverified_recipients = send_email(
-                        recipients, subject, body, campaign_id, DEFAULT_FROM_EMAIL
-                    )
-                    
-                    if success:
-                        if len(failed_recipients) == 0 and len(unverified_recipients) == 0:
-                            update_email_status(campaign_id, email_id, "SENT")
-                        elif len(unverified_recipients) > 0:
-                            update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                        else:
-                            update_email_status(campaign_id, email_id, "PARTIALLY_SENT")
-                    else:
-                        if len(unverified_recipients) > 0:
-                            update_email_status(campaign_id, email_id, "PENDING_VERIFICATION", unverified_emails=unverified_recipients)
-                        else:
-                            update_email_status(campaign_id, email_id, "FAILED")
-                except Exception as e:
-                    logger.error(f"Error processing pending email {email.get('campaign_id', 'unknown')}: {str(e)}")
-                    continue
-                    
+    return {"statusCode": 200, "body": "Emails processed successfully"}
+
+TRIGGER_HANDLERS = {
+    "sqs": handle_sqs,
+    "scheduler": handle_scheduler,
+    "api_resend": handle_api_resend,
+    "direct": handle_direct,
+    "sweep": handle_sweep,
+}
+
+def lambda_handler(event, context):
+    logger.info("Lambda triggered: Processing emails...")
+    logger.info(f"Event received: {to_json(event)}")
+
+    started = time.monotonic()
+    invocation_state.lease_owner = f"lease-{getattr(context, 'aws_request_id', None) or uuid.uuid4()}"
+    budget = WorkBudget(context)
+    trigger = "unknown"
+    try:
+        trigger, payload = classify_event(event)
+        logger.info(f"Dispatching trigger: {trigger}")
+        return TRIGGER_HANDLERS[trigger](payload, budget)
     except Exception as e:
         logger.error(f"Error in Lambda execution: {str(e)}")
-        return {
-            "statusCode": 500,
-            "headers": {
-                "Access-Control-Allow-Origin": "https://main.d1c35am1kqmp7j.amplifyapp.com",
-                "Access-Control-Allow-Methods": "POST,OPTIONS",
-                "Access-Control-Allow-Headers": "Authorization,Content-Type"
-            },
-            "body": json.dumps({"message": f"Error processing emails: {str(e)}"})
-        }
-
-    return {"statusCode": 200, "body": "Emails processed successfully"}
\ No newline at end of file
+        return api_response(500, f"Error processing emails: {str(e)}")
+    finally:
+        logger.info(f"Trigger {trigger} handled in {(time.monotonic() - started) * 1000:.0f} ms")
\ No newline at end of file
@@ -0,0 +1,46 @@
+import os
+import sys
+import threading
+
+import pytest
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sendEmailLambda  # noqa: E402
+from fakes import FakeSes, FakeSqs, InMemoryTable  # noqa: E402
+
+
+@pytest.fixture
+def lambda_env(monkeypatch):
+    """sendEmailLambda với DynamoDB, SQS và SES thay bằng stub trong bộ nhớ."""
+    module = sendEmailLambda
+    conditional_error = module.dynamodb.meta.client.exceptions.ConditionalCheckFailedException
+    campaigns = InMemoryTable(("campaign_id", "email_id"), conditional_error)
+    ledger = InMemoryTable(("campaign_id", "batch_id"), conditional_error)
+    tracking = InMemoryTable(("message_id",), conditional_error)
+    sqs = FakeSqs()
+    ses = FakeSes()
+
+    monkeypatch.setattr(module, "table", campaigns)
+    monkeypatch.setattr(module, "ledger_table", ledger)
+    monkeypatch.setattr(module.dynamodb, "Table", lambda name: tracking)
+    monkeypatch.setattr(module, "sqs", sqs)
+    monkeypatch.setattr(module, "invocation_state", threading.local())
+    monkeypatch.setattr(module, "sender_pool", module.SenderPool([
+        module.SenderEndpoint("us-east-1", module.DEFAULT_FROM_EMAIL, "cs", 10000, client=ses)
+    ]))
+
+    class Env:
+        pass
+
+    env = Env()
+    env.module = module
+    env.campaigns = campaigns
+    env.ledger = ledger
+    env.tracking = tracking
+    env.sqs = sqs
+    env.ses = ses
+    return env
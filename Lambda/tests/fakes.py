@@ -0,0 +1,297 @@
+"""Stub trong bộ nhớ cho DynamoDB, SQS và SES dùng trong test.
+
+InMemoryTable hiểu đúng phần cú pháp ConditionExpression / UpdateExpression
+mà sendEmailLambda dùng, và mọi thao tác ghi có điều kiện đều atomic (có lock)
+để test nhiều invocation chạy song song.
+"""
+import copy
+import re
+import threading
+import time
+
+TOKEN_PATTERN = re.compile(r"\s*(<>|<=|>=|[=<>(),+]|[#:]?[A-Za-z_][A-Za-z0-9_]*)")
+MISSING = object()
+
+
+def tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN_PATTERN.match(expression, position)
+        if not match:
+            raise ValueError(f"Cannot parse expression at: {expression[position:]}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class ExpressionParser:
+    def __init__(self, expression, names, values):
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token is None or token.upper() != expected):
+            raise ValueError(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def attribute(self, token):
+        return self.names.get(token, token)
+
+    # Condition expression: OR > AND > NOT > so sánh / hàm
+    def condition(self):
+        left = self.conjunction()
+        while self.peek() and self.peek().upper() == "OR":
+            self.take()
+            right = self.conjunction()
+            left = (lambda a, b: lambda item: a(item) or b(item))(left, right)
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.peek() and self.peek().upper() == "AND":
+            self.take()
+            right = self.negation()
+            left = (lambda a, b: lambda item: a(item) and b(item))(left, right)
+        return left
+
+    def negation(self):
+        if self.peek() and self.peek().upper() == "NOT":
+            self.take()
+            inner = self.negation()
+            return lambda item: not inner(item)
+        return self.primary()
+
+    def primary(self):
+        token = self.peek()
+        if token == "(":
+            self.take()
+            inner = self.condition()
+            self.take(")")
+            return inner
+        if token in ("attribute_exists", "attribute_not_exists"):
+            self.take()
+            self.take("(")
+            name = self.attribute(self.take())
+            self.take(")")
+            if token == "attribute_exists":
+                return lambda item: name in item
+            return lambda item: name not in item
+
+        left = self.operand()
+        operator = self.take()
+        right = self.operand()
+        compare = {
+            "=": lambda a, b: a == b,
+            "<>": lambda a, b: a != b,
+            "<": lambda a, b: a < b,
+            "<=": lambda a, b: a <= b,
+            ">": lambda a, b: a > b,
+            ">=": lambda a, b: a >= b,
+        }[operator]
+
+        def evaluate(item):
+            a, b = left(item), right(item)
+            if a is MISSING or b is MISSING:
+                return False
+            return compare(a, b)
+
+        return evaluate
+
+    def operand(self):
+        token = self.take()
+        if token.startswith(":"):
+            value = self.values[token]
+            return lambda item: value
+        if token == "if_not_exists":
+            self.take("(")
+            name = self.attribute(self.take())
+            self.take(",")
+            fallback = self.operand()
+            self.take(")")
+            return lambda item: item[name] if name in item else fallback(item)
+        name = self.attribute(token)
+        return lambda item: item.get(name, MISSING)
+
+    # Update expression: chỉ hỗ trợ SET (gán, if_not_exists, +) và REMOVE
+    def update(self):
+        actions = []
+        while self.peek() is not None:
+            clause = self.take().upper()
+            while self.peek() is not None and self.peek().upper() not in ("SET", "REMOVE"):
+                name = self.attribute(self.take())
+                if clause == "SET":
+                    self.take("=")
+                    value = self.operand()
+                    if self.peek() == "+":
+                        self.take()
+                        increment = self.operand()
+                        value = (lambda a, b: lambda item: a(item) + b(item))(value, increment)
+                    actions.append((clause, name, value))
+                else:
+                    actions.append((clause, name, None))
+                if self.peek() == ",":
+                    self.take()
+        return actions
+
+
+def compile_condition(expression, names=None, values=None):
+    if not expression:
+        return lambda item: True
+    return ExpressionParser(expression, names, values).condition()
+
+
+class InMemoryTable:
+    def __init__(self, key_names, conditional_error):
+        self.key_names = key_names
+        self.conditional_error = conditional_error
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def key_of(self, key):
+        return tuple(key[name] for name in self.key_names)
+
+    def fail_condition(self, operation):
+        return self.conditional_error(
+            {"Error": {"Code": "ConditionalCheckFailedException", "Message": "The conditional request failed"}},
+            operation
+        )
+
+    def get_item(self, Key, ConsistentRead=False):
+        with self.lock:
+            item = self.items.get(self.key_of(Key))
+            return {"Item": copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        condition = compile_condition(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            key = self.key_of(Item)
+            if not condition(self.items.get(key, {})):
+                raise self.fail_condition("PutItem")
+            self.items[key] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        condition = compile_condition(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        actions = ExpressionParser(UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues).update()
+        with self.lock:
+            key = self.key_of(Key)
+            current = self.items.get(key, {})
+            if not condition(current):
+                raise self.fail_condition("UpdateItem")
+            updated = dict(current, **Key)
+            for clause, name, value in actions:
+                if clause == "SET":
+                    updated[name] = value(current)
+                else:
+                    updated.pop(name, None)
+            self.items[key] = updated
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        condition = compile_condition(ConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            key = self.key_of(Key)
+            if not condition(self.items.get(key, {})):
+                raise self.fail_condition("DeleteItem")
+            self.items.pop(key, None)
+        return {}
+
+    def scan(self, FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        condition = compile_condition(FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        with self.lock:
+            return {"Items": [copy.deepcopy(item) for item in self.items.values() if condition(item)]}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues=None, ExpressionAttributeNames=None, IndexName=None):
+        return self.scan(KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+
+    def batch_writer(self):
+        return BatchWriter(self)
+
+
+class BatchWriter:
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+
+class FakeSqs:
+    def __init__(self):
+        self.sent = []
+        self.deleted = []
+        self.lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+        with self.lock:
+            self.sent.append({"body": MessageBody, "delay": DelaySeconds})
+        return {"MessageId": f"sqs-{len(self.sent)}"}
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        with self.lock:
+            self.deleted.append(ReceiptHandle)
+        return {}
+
+
+class FakeSes:
+    """Stub SES: ghi lại từng destination đã gửi, có thể chậm hoặc lỗi theo ý test."""
+
+    def __init__(self, latency=0.0, error=None, fail_after=None, status_for=None):
+        self.latency = latency
+        self.error = error
+        self.fail_after = fail_after
+        # status_for(recipient) trả về status khác "Success" để giả lập lỗi theo từng destination
+        self.status_for = status_for
+        self.calls = 0
+        self.delivered = []
+        self.lock = threading.Lock()
+
+    def send_bulk_templated_email(self, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            if self.error is not None and (self.fail_after is None or self.calls > self.fail_after):
+                raise self.error
+            statuses = []
+            for destination in kwargs["Destinations"]:
+                recipient = destination["Destination"]["ToAddresses"][0]
+                status = self.status_for(recipient) if self.status_for else None
+                if status:
+                    statuses.append({"Status": status, "Error": f"{status} for {recipient}"})
+                    continue
+                self.delivered.append(recipient)
+                statuses.append({"Status": "Success", "MessageId": f"ses-{len(self.delivered)}"})
+        return {"Status": statuses}
+
+
+class FakeClock:
+    """Thay module time: sleep() chỉ tua đồng hồ giả để đo throughput không phải chờ thật."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return time.time()
@@ -0,0 +1,209 @@
+import json
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from fakes import FakeSes
+
+
+def seed_campaign(env, recipients, status="PENDING", **extra):
+    item = {
+        "campaign_id": "campaign#c1",
+        "email_id": "email#regular",
+        "subject": "Hello",
+        "body": "<p>Hi http://example.com/a</p>",
+        "recipients": recipients,
+        "status": status,
+    }
+    item.update(extra)
+    env.campaigns.put_item(Item=item)
+
+
+def sqs_event(recipients, receipt="r1"):
+    body = {
+        "campaign_id": "campaign#c1",
+        "email_id": "email#regular",
+        "recipients": recipients,
+        "subject": "Hello",
+        "body": "<p>Hi http://example.com/a</p>",
+    }
+    return {"Records": [{"body": json.dumps(body), "receiptHandle": receipt}]}
+
+
+def invocation(request_id):
+    # Mỗi lần gọi handler là một invocation riêng, có lease owner riêng
+    return SimpleNamespace(aws_request_id=request_id)
+
+
+def campaign_status(env):
+    return env.campaigns.get_item(Key={"campaign_id": "campaign#c1", "email_id": "email#regular"})["Item"]["status"]
+
+
+def test_concurrent_sqs_redelivery_sends_each_recipient_once(lambda_env):
+    recipients = [f"user{i}@example.com" for i in range(120)]
+    seed_campaign(lambda_env, recipients, status="SCHEDULED")
+    lambda_env.ses.latency = 0.02
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda i: lambda_env.module.lambda_handler(sqs_event(recipients, f"r{i}"), invocation(f"req-{i}")),
+                      range(4)))
+
+    assert Counter(lambda_env.ses.delivered) == Counter(recipients)
+    assert campaign_status(lambda_env) == "SENT"
+
+
+def test_redelivery_after_sent_is_skipped(lambda_env):
+    recipients = ["a@example.com", "b@example.com"]
+    seed_campaign(lambda_env, recipients)
+
+    lambda_env.module.lambda_handler(sqs_event(recipients), None)
+    lambda_env.module.lambda_handler(sqs_event(recipients, "r2"), None)
+
+    assert sorted(lambda_env.ses.delivered) == recipients
+    assert campaign_status(lambda_env) == "SENT"
+    assert lambda_env.sqs.deleted == ["r1", "r2"]
+
+
+def test_sweep_and_sqs_divide_work(lambda_env):
+    recipients = [f"user{i}@example.com" for i in range(150)]
+    seed_campaign(lambda_env, recipients)
+    lambda_env.ses.latency = 0.02
+
+    events = [sqs_event(recipients), {}, sqs_event(recipients, "r2"), {}]
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        list(pool.map(lambda i: lambda_env.module.lambda_handler(events[i], invocation(f"req-{i}")), range(4)))
+
+    assert Counter(lambda_env.ses.delivered) == Counter(recipients)
+
+
+def test_sweep_reclaims_expired_lease_and_resumes_from_ledger(lambda_env):
+    module = lambda_env.module
+    recipients = [f"user{i}@example.com" for i in range(100)]
+    expired = int(time.time()) - 1
+    seed_campaign(lambda_env, recipients, status="SENDING", lease_owner="lease-crashed", lease_expires_at=expired)
+    lambda_env.ledger.put_item(Item={
+        "campaign_id": "campaign#c1", "batch_id": "email#regular#batch#0", "status": "SENT",
+        "ses_message_ids": [f"old-{i}" for i in range(50)], "failed_recipients": [], "unverified_recipients": []
+    })
+    lambda_env.ledger.put_item(Item={
+        "campaign_id": "campaign#c1", "batch_id": "email#regular#batch#1", "status": "SENDING",
+        "lease_owner": "lease-crashed", "lease_expires_at": expired
+    })
+
+    module.lambda_handler({}, None)
+
+    assert sorted(lambda_env.ses.delivered) == sorted(recipients[50:])
+    assert campaign_status(lambda_env) == "SENT"
+
+
+def test_live_sweep_lease_is_not_reclaimed(lambda_env):
+    recipients = ["a@example.com"]
+    seed_campaign(lambda_env, recipients, status="SENDING", lease_owner="lease-other",
+                  lease_expires_at=int(time.time()) + 600)
+
+    lambda_env.module.lambda_handler({}, None)
+    lambda_env.module.lambda_handler(sqs_event(recipients), None)
+
+    assert lambda_env.ses.delivered == []
+    assert campaign_status(lambda_env) == "SENDING"
+
+
+def test_busy_batch_is_not_finalized(lambda_env):
+    recipients = [f"user{i}@example.com" for i in range(60)]
+    seed_campaign(lambda_env, recipients)
+    lambda_env.ledger.put_item(Item={
+        "campaign_id": "campaign#c1", "batch_id": "email#regular#batch#1", "status": "SENDING",
+        "lease_owner": "lease-other", "lease_expires_at": int(time.time()) + 600
+    })
+
+    module = lambda_env.module
+    module.lambda_handler(sqs_event(recipients), None)
+    module.lambda_handler({}, None)
+
+    assert sorted(lambda_env.ses.delivered) == sorted(recipients[:50])
+    item = lambda_env.campaigns.get_item(Key={"campaign_id": "campaign#c1", "email_id": "email#regular"})["Item"]
+    assert item["status"] == "QUEUED"
+    assert abs(item["lease_expires_at"] - (time.time() + module.BUSY_RETRY_DELAY_SECONDS)) < 60
+    assert len(lambda_env.sqs.sent) == 1
+    assert lambda_env.sqs.sent[0]["delay"] == module.BUSY_RETRY_DELAY_SECONDS
+
+    lambda_env.ledger.delete_item(Key={"campaign_id": "campaign#c1", "batch_id": "email#regular#batch#1"})
+    module.lambda_handler({"Records": [{"body": lambda_env.sqs.sent[0]["body"], "receiptHandle": "retry"}]}, None)
+
+    assert Counter(lambda_env.ses.delivered) == Counter(recipients)
+    assert campaign_status(lambda_env) == "SENT"
+
+
+def test_failed_batch_releases_ledger_lease(lambda_env, monkeypatch):
+    module = lambda_env.module
+    recipients = ["a@example.com", "b@example.com"]
+    seed_campaign(lambda_env, recipients)
+    monkeypatch.setattr(module.sender_pool.endpoints[0], "client", FakeSes(error=ConnectionError("boom")))
+
+    module.lambda_handler(sqs_event(recipients), None)
+
+    assert lambda_env.ledger.items == {}
+    assert campaign_status(lambda_env) == "FAILED"
+
+
+def test_redelivery_does_not_overwrite_feedback_status(lambda_env):
+    recipients = ["a@example.com", "b@example.com"]
+    for status in ("OPENED", "CLICKED"):
+        seed_campaign(lambda_env, recipients, status=status, retry_count=1)
+
+        lambda_env.module.lambda_handler(sqs_event(recipients, f"r-{status}"), None)
+
+        item = lambda_env.campaigns.get_item(Key={"campaign_id": "campaign#c1", "email_id": "email#regular"})["Item"]
+        assert item["status"] == status
+        assert item["retry_count"] == 1
+        assert "lease_owner" not in item
+    assert lambda_env.ses.delivered == []
+    assert lambda_env.sqs.deleted == ["r-OPENED", "r-CLICKED"]
+
+
+def test_invocation_cannot_release_another_invocations_batch(lambda_env):
+    module = lambda_env.module
+    key = {"campaign_id": "campaign#c1", "batch_id": "email#regular#batch#0"}
+
+    module.invocation_state.lease_owner = "lease-req-a"
+    assert module.claim_batch("campaign#c1", "email#regular", 0) == (True, None)
+
+    module.invocation_state.lease_owner = "lease-req-b"
+    module.release_batch("campaign#c1", "email#regular", 0)
+    assert lambda_env.ledger.get_item(Key=key)["Item"]["lease_owner"] == "lease-req-a"
+
+    module.invocation_state.lease_owner = "lease-req-a"
+    module.release_batch("campaign#c1", "email#regular", 0)
+    assert lambda_env.ledger.get_item(Key=key) == {}
+
+
+def test_each_invocation_gets_its_own_lease_owner(lambda_env, monkeypatch):
+    recipients = ["a@example.com"]
+    seed_campaign(lambda_env, recipients)
+    owners = []
+    original_claim = lambda_env.module.claim_batch
+
+    def recording_claim(*args):
+        owners.append(lambda_env.module.current_lease_owner())
+        return original_claim(*args)
+
+    monkeypatch.setattr(lambda_env.module, "claim_batch", recording_claim)
+    lambda_env.module.lambda_handler(sqs_event(recipients), invocation("req-1"))
+    seed_campaign(lambda_env, recipients)
+    lambda_env.ledger.items.clear()
+    lambda_env.module.lambda_handler(sqs_event(recipients, "r2"), invocation("req-2"))
+
+    assert owners == ["lease-req-1", "lease-req-2"]
+
+
+def test_ledger_items_carry_ttl(lambda_env):
+    module = lambda_env.module
+    recipients = ["a@example.com"]
+    seed_campaign(lambda_env, recipients)
+
+    module.lambda_handler(sqs_event(recipients), None)
+
+    item = lambda_env.ledger.get_item(Key={"campaign_id": "campaign#c1", "batch_id": "email#regular#batch#0"})["Item"]
+    assert item["status"] == "SENT"
+    assert abs(item["expires_at"] - (time.time() + module.LEDGER_TTL_SECONDS)) < 60
@@ -0,0 +1,115 @@
+from collections import Counter
+
+import pytest
+
+from fakes import FakeClock, FakeSes
+
+
+def make_pool(module, rates, clients=None):
+    clients = clients or [FakeSes() for _ in rates]
+    endpoints = [
+        module.SenderEndpoint(f"region-{i}", module.DEFAULT_FROM_EMAIL, "cs", rate, client=client)
+        for i, (rate, client) in enumerate(zip(rates, clients))
+    ]
+    return module.SenderPool(endpoints)
+
+
+def recipients_across_domains(count):
+    return [f"user{i}@domain{i % 200}.example" for i in range(count)]
+
+
+@pytest.fixture
+def clock(lambda_env, monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(lambda_env.module, "time", fake)
+    return fake
+
+
+def throughput(env, clock, monkeypatch, rates, count=2000):
+    pool = make_pool(env.module, rates)
+    monkeypatch.setattr(env.module, "sender_pool", pool)
+    started = clock.now
+    success, ses_ids, failed, unverified, incomplete = env.module.send_email(
+        recipients_across_domains(count), "Hi", "<p>body</p>", "campaign#tp"
+    )
+    assert success and len(ses_ids) == count and not failed and not incomplete
+    return count / (clock.now - started)
+
+
+def test_aggregate_throughput_scales_with_pool(lambda_env, clock, monkeypatch):
+    single = throughput(lambda_env, clock, monkeypatch, [100])
+    double = throughput(lambda_env, clock, monkeypatch, [100, 100])
+    mixed = throughput(lambda_env, clock, monkeypatch, [100, 100, 200])
+
+    assert single == pytest.approx(100, rel=0.1)
+    assert double > 1.6 * single
+    assert mixed > 3 * single
+
+
+def test_routing_is_weighted_and_sticky_per_domain(lambda_env):
+    pool = make_pool(lambda_env.module, [100, 300])
+    recipients = recipients_across_domains(4000)
+
+    routed = Counter(pool.route(recipient).name for recipient in recipients)
+    share = routed["region-1/" + lambda_env.module.DEFAULT_FROM_EMAIL] / len(recipients)
+    assert 0.6 < share < 0.9
+
+    for recipient in recipients[:200]:
+        same_domain = "other@" + recipient.split("@")[1]
+        assert pool.route(recipient) is pool.route(same_domain)
+
+
+def test_endpoint_error_fails_over_and_keeps_partial_results(lambda_env, clock, monkeypatch):
+    healthy = FakeSes()
+    broken = FakeSes(error=ConnectionError("connection reset"))
+    pool = make_pool(lambda_env.module, [1000, 1000], [healthy, broken])
+    monkeypatch.setattr(lambda_env.module, "sender_pool", pool)
+    recipients = recipients_across_domains(50)
+
+    success, ses_ids, failed, unverified, incomplete = lambda_env.module.send_email(
+        recipients, "Hi", "<p>body</p>", "campaign#fo", ledger_key="email#regular"
+    )
+
+    assert success and len(ses_ids) == 50 and not failed
+    assert Counter(healthy.delivered) == Counter(recipients)
+    assert not pool.endpoints[1].is_healthy()
+    sends = [item for item in lambda_env.tracking.items.values() if item["event_type"] == "Send"]
+    assert len(sends) == 50
+    assert lambda_env.ledger.items[("campaign#fo", "email#regular#batch#0")]["status"] == "SENT"
+
+
+def test_all_endpoints_failing_keeps_results_already_sent(lambda_env, clock, monkeypatch):
+    first = FakeSes(error=ConnectionError("down"), fail_after=1)
+    second = FakeSes(error=ConnectionError("down"))
+    pool = make_pool(lambda_env.module, [1000, 1000], [first, second])
+    monkeypatch.setattr(lambda_env.module, "sender_pool", pool)
+    recipients = recipients_across_domains(50)
+    indexes_on_first = [i for i, r in enumerate(recipients) if pool.route(r) is pool.endpoints[0]]
+
+    results, unsent = lambda_env.module.send_bulk_via_pool(
+        recipients, [{"Destination": {"ToAddresses": [r]}} for r in recipients], lambda_env.module.DEFAULT_FROM_EMAIL
+    )
+
+    assert sorted(idx for idx, _ in results) == indexes_on_first
+    assert sorted(unsent) == sorted(set(range(50)) - set(indexes_on_first))
+
+
+def test_throttled_destinations_fail_over_without_being_recorded(lambda_env, clock, monkeypatch):
+    recipients = recipients_across_domains(50)
+    throttled = set(recipients[::3])
+    first = FakeSes(status_for=lambda r: "AccountThrottled" if r in throttled else None)
+    second = FakeSes()
+    pool = make_pool(lambda_env.module, [1000, 1000], [first, second])
+    monkeypatch.setattr(lambda_env.module, "sender_pool", pool)
+    on_first = [r for r in recipients if pool.route(r) is pool.endpoints[0]]
+
+    success, ses_ids, failed, unverified, incomplete = lambda_env.module.send_email(
+        recipients, "Hi", "<p>body</p>", "campaign#th", ledger_key="email#regular"
+    )
+
+    assert success and len(ses_ids) == 50 and not failed
+    assert Counter(first.delivered + second.delivered) == Counter(recipients)
+    assert set(second.delivered) >= throttled & set(on_first)
+    assert not pool.endpoints[0].is_healthy()
+    ledger = lambda_env.ledger.items[("campaign#th", "email#regular#batch#0")]
+    assert ledger["status"] == "SENT" and ledger["failed_recipients"] == []
@@ -0,0 +1,45 @@
+import json
+from decimal import Decimal
+
+import pytest
+
+import sendEmailLambda
+
+SUBJECTS = ['Say "hi"', "Line one\nLine two", "Khuyến mãi 🎉 tháng 10", None, "lone \ud800 surrogate"]
+BODIES = ['<a href="http://example.com/?q=\\"x\\"">link</a>', "tab\there\r\nnext", "Xin chào, thế giới", ""]
+
+
+@pytest.fixture(params=["orjson", "stdlib"])
+def module(request, monkeypatch):
+    if request.param == "orjson":
+        if sendEmailLambda.orjson is None:
+            pytest.skip("orjson not installed")
+    else:
+        monkeypatch.setattr(sendEmailLambda, "orjson", None)
+    return sendEmailLambda
+
+
+@pytest.mark.parametrize("subject", SUBJECTS)
+@pytest.mark.parametrize("body", BODIES)
+def test_template_data_matches_json_dumps(module, subject, body):
+    encoder = module.TemplateDataEncoder("campaign#c1", subject)
+
+    encoded = encoder.encode("msg-1", "Người Nhận <a@example.com>", body)
+
+    assert json.loads(encoded) == json.loads(json.dumps({
+        "campaign_id": "c1",
+        "message_id": "msg-1",
+        "recipient": "Người Nhận <a@example.com>",
+        "body": body,
+        "subject": subject
+    }))
+
+
+def test_to_json_stringifies_unknown_types(module):
+    item = {"campaign_id": "campaign#c1", "retry_count": Decimal("2"), "score": Decimal("1.5"), "subject": None}
+
+    assert json.loads(module.to_json(item)) == json.loads(json.dumps(item, default=str))
+
+
+def test_encode_string_handles_lone_surrogate(module):
+    assert json.loads(module.encode_string("a\ud800b")) == "a\ud800b"
@@ -0,0 +1,30 @@
+import urllib.parse
+
+
+def test_links_are_wrapped_with_quoted_url_and_recipient(lambda_env):
+    module = lambda_env.module
+    body = '<a href="https://shop.example.com/p?id=1">x</a> <img src="https://cdn.example.com/logo.png"> {name}'
+    builder = module.TrackingUrlBuilder(body, "campaign#abc")
+
+    rendered = builder.render("msg-1", "a+b@example.com")
+
+    expected_url = (
+        f"https://{module.TRACKING_DOMAIN}/campaigns/abc/tracking/click?message_id=msg-1"
+        f"&url={urllib.parse.quote('https://shop.example.com/p?id=1')}&recipient=a%2Bb%40example.com"
+    )
+    assert rendered == f'<a href="{expected_url}">x</a> <img src="https://cdn.example.com/logo.png"> {{name}}'
+    assert builder.link_count == 1
+
+
+def test_braces_in_campaign_id_are_escaped(lambda_env):
+    builder = lambda_env.module.TrackingUrlBuilder("see https://example.com", "campaign#{x}")
+
+    assert "/campaigns/{x}/tracking/click?message_id=msg-1&" in builder.render("msg-1", "a@example.com")
+
+
+def test_body_without_links_is_returned_unchanged(lambda_env):
+    module = lambda_env.module
+    for body in ("<p>no links</p>", "", None):
+        builder = module.TrackingUrlBuilder(body, "campaign#abc")
+        assert builder.link_count == 0
+        assert builder.render_batch(["msg-1", "msg-2"], ["a@example.com", "b@example.com"]) == [body, body]
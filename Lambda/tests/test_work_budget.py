@@ -0,0 +1,96 @@
+import json
+
+from fakes import FakeClock
+
+
+class FakeContext:
+    def __init__(self, remaining_ms, clock=None):
+        self.remaining_ms = remaining_ms
+        self.clock = clock
+
+    def get_remaining_time_in_millis(self):
+        elapsed_ms = self.clock.now * 1000 if self.clock else 0
+        return self.remaining_ms - elapsed_ms
+
+
+def sqs_record(campaign_id, recipients, receipt):
+    body = {"campaign_id": campaign_id, "recipients": recipients, "subject": "Hi", "body": "<p>body</p>"}
+    return {"body": json.dumps(body), "receiptHandle": receipt}
+
+
+def test_short_timeout_still_sends(lambda_env):
+    event = {"Records": [sqs_record("campaign#short", ["a@example.com"], "r1")]}
+
+    lambda_env.module.lambda_handler(event, FakeContext(8000))
+
+    assert lambda_env.ses.delivered == ["a@example.com"]
+    assert lambda_env.sqs.sent == []
+
+
+def test_default_lambda_timeout_makes_progress(lambda_env):
+    event = {"Records": [sqs_record(f"campaign#{i}", [f"user{i}@example.com"], f"r{i}") for i in range(3)]}
+
+    lambda_env.module.lambda_handler(event, FakeContext(3000))
+
+    assert len(lambda_env.ses.delivered) == 3
+
+
+def test_exhausted_budget_hands_off_remaining_messages(lambda_env, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lambda_env.module, "time", clock)
+    module = lambda_env.module
+    monkeypatch.setattr(module, "sender_pool", module.SenderPool([
+        module.SenderEndpoint("us-east-1", module.DEFAULT_FROM_EMAIL, "cs", 10000, client=lambda_env.ses)
+    ]))
+    original_send = lambda_env.ses.send_bulk_templated_email
+
+    def slow_send(**kwargs):
+        clock.sleep(20)
+        return original_send(**kwargs)
+
+    monkeypatch.setattr(lambda_env.ses, "send_bulk_templated_email", slow_send)
+    records = [sqs_record(f"campaign#{i}", [f"user{i}@example.com"], f"r{i}") for i in range(5)]
+
+    lambda_env.module.lambda_handler({"Records": records}, FakeContext(60000, clock))
+
+    assert lambda_env.ses.delivered == ["user0@example.com", "user1@example.com"]
+    assert [json.loads(message["body"])["campaign_id"] for message in lambda_env.sqs.sent] == [
+        "campaign#2", "campaign#3", "campaign#4"
+    ]
+    assert sorted(lambda_env.sqs.deleted) == ["r0", "r1", "r2", "r3", "r4"]
+
+
+def test_exhausted_sweep_queues_each_email_once(lambda_env, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(lambda_env.module, "time", clock)
+    module = lambda_env.module
+    monkeypatch.setattr(module, "sender_pool", module.SenderPool([
+        module.SenderEndpoint("us-east-1", module.DEFAULT_FROM_EMAIL, "cs", 10000, client=lambda_env.ses)
+    ]))
+    original_send = lambda_env.ses.send_bulk_templated_email
+
+    def slow_send(**kwargs):
+        clock.sleep(20)
+        return original_send(**kwargs)
+
+    monkeypatch.setattr(lambda_env.ses, "send_bulk_templated_email", slow_send)
+    for i in range(4):
+        lambda_env.campaigns.put_item(Item={
+            "campaign_id": f"campaign#{i}", "email_id": "email#regular", "status": "PENDING",
+            "recipients": [f"user{i}@example.com"], "subject": "Hi", "body": "<p>body</p>"
+        })
+
+    module.lambda_handler({}, FakeContext(60000, clock))
+    module.lambda_handler({}, FakeContext(60000))
+
+    assert lambda_env.ses.delivered == ["user0@example.com", "user1@example.com"]
+    assert [json.loads(message["body"])["campaign_id"] for message in lambda_env.sqs.sent] == ["campaign#2", "campaign#3"]
+    statuses = [lambda_env.campaigns.get_item(Key={"campaign_id": f"campaign#{i}", "email_id": "email#regular"})["Item"]["status"]
+                for i in range(4)]
+    assert statuses == ["SENT", "SENT", "QUEUED", "QUEUED"]
+
+    handed_off = lambda_env.sqs.sent[0]["body"]
+    module.lambda_handler({"Records": [{"body": handed_off, "receiptHandle": "q0"}]}, None)
+
+    assert lambda_env.ses.delivered[-1] == "user2@example.com"
+    assert lambda_env.campaigns.get_item(Key={"campaign_id": "campaign#2", "email_id": "email#regular"})["Item"]["status"] == "SENT"